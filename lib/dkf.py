@@ -8,6 +8,12 @@ from lib.integrator import Integrator
 from typing import Callable
 import numpy as np
 
+def apply(F_t, x: np.ndarray, out: np.ndarray):
+	''' F_t x written into out; re-projected in place if F_t is a Koopman operator '''
+	if hasattr(F_t, 'apply'):
+		return F_t.apply(x, out=out)
+	return np.matmul(F_t, x, out=out)
+
 class DKF:
 	def __init__(self, x0: np.ndarray, F: Callable, H: np.ndarray, Q: np.ndarray, R: np.ndarray, dt: float):
 		self.F = F
@@ -19,12 +25,18 @@ class DKF:
 		self.ndim = x0.shape[0]
 		rep_ndim = self.ndim*(self.ndim+1) # representational dimension
 
+		# propagation buffers
+		self.Fx_t = np.empty((self.ndim, 1))
+		self.FK_t = np.empty((self.ndim, H.shape[0]))
+		self.FP_t = np.empty((self.ndim, self.ndim))
+		self.FFP_t = np.empty((self.ndim, self.ndim))
+
 		def f(t, x_t, P_t, z_t):
 			F_t = self.F(t)
 			M_t = self.H@P_t@self.H.T + self.R
 			K_t = P_t@self.H.T@np.linalg.inv(M_t)
-			x_t = F_t@x_t + F_t@K_t@(z_t - self.H@x_t)
-			P_t = (F_t@(F_t@(P_t - K_t@self.H@P_t)).T).T + self.Q
+			x_t = apply(F_t, x_t, self.Fx_t) + apply(F_t, K_t, self.FK_t)@(z_t - self.H@x_t)
+			P_t = apply(F_t, apply(F_t, P_t - K_t@self.H@P_t, self.FP_t).T, self.FFP_t).T + self.Q
 			return x_t, P_t
 		self.f = f
 
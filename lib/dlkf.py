@@ -58,6 +58,12 @@ class DLKF:
 
 		self.P_act_till = np.zeros((self.tau_n, self.ndim, self.ndim))
 
+		# propagation buffers
+		self.Fx_t = np.empty((self.ndim, 1))
+		self.FK_t = np.empty((self.ndim, H.shape[0]))
+		self.FP_t = np.empty((self.ndim, self.ndim))
+		self.FFP_t = np.empty((self.ndim, self.ndim))
+
 		def f(t, x_t, P_t, z_t):
 			F_t = self.F(t)
 			M_t = self.H@P_t@self.H.T + self.R
@@ -105,8 +111,8 @@ class DLKF:
 
 			# Method 2
 			F_t.set_offset(-self.eta_t)
-			x_t = F_t@x_t + F_t@K_t@(z_t - self.H@x_t)
-			P_t = (F_t@(F_t@(P_t - K_t@self.H@P_t)).T).T + self.Q
+			x_t = F_t.apply(x_t, out=self.Fx_t) + F_t.apply(K_t, out=self.FK_t)@(z_t - self.H@x_t)
+			P_t = F_t.apply(F_t.apply(P_t - K_t@self.H@P_t, out=self.FP_t).T, out=self.FFP_t).T + self.Q
 			F_t.zero_offset()
 			return x_t, P_t
 		self.f = f
@@ -10,8 +10,11 @@ from lib.integrator import Integrator
 from totorch.operators import Koopman
 
 class KKF:
-	def __init__(self, x0: np.ndarray, K: Koopman, H: np.ndarray, Q: np.ndarray, R: np.ndarray, dt: float):
-		self.F = lambda x: (K@x - x) / dt # Approximate differential model with forward-difference
+	def __init__(self, x0: np.ndarray, K: Koopman, H: np.ndarray, Q: np.ndarray, R: np.ndarray, dt: float, L: np.ndarray = None):
+		if L is None:
+			self.F = lambda x: (K@x - x) / dt # Approximate differential model with forward-difference
+		else:
+			self.F = lambda x: L@x # Koopman generator (see `totorch.operators.solve_generator`), independent of data dt
 		self.H = H
 		self.Q = Q
 		self.R = R
@@ -13,9 +13,13 @@ from totorch.operators import Koopman
 class LKKF:
 	def __init__(self, 
 		x0: np.ndarray, K: Koopman, H: np.ndarray, Q: np.ndarray, R: np.ndarray, 	# KF parameters
-		dt: float, tau=float('inf'), eps=1e-4, gamma=1.								# Hyperparameters
+		dt: float, tau=float('inf'), eps=1e-4, gamma=1.,							# Hyperparameters
+		L: np.ndarray = None 														# (optional) Koopman generator
 	):
-		self.F = lambda x: (K@x - x) / dt # Approximate differential model with forward-difference
+		if L is None:
+			self.F = lambda x: (K@x - x) / dt # Approximate differential model with forward-difference
+		else:
+			self.F = lambda x: L@x # Koopman generator (see `totorch.operators.solve_generator`), independent of data dt
 		self.H = H
 		self.Q = Q
 		self.R = R
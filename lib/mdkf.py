@@ -0,0 +1,89 @@
+''' Discrete-time Kalman filter in Koopman modal coordinates
+'''
+
+from systems.nonlinear import VanDerPol
+from utils import set_seed
+from totorch.operators import ModalKoopman
+
+import numpy as np
+
+class MDKF:
+	def __init__(self, x0: np.ndarray, K: ModalKoopman, H: np.ndarray, Q: np.ndarray, R: np.ndarray, dt: float):
+		self.K = K
+		self.H = H
+		self.Q = Q
+		self.R = R
+		self.t = 0
+		self.dt = dt
+		self.ndim = x0.shape[0]
+
+		# Modal-coordinate model; update uses information form so per-step inversions are r x r
+		self.H_m = H@K.V
+		HR = np.conj(self.H_m).T@np.linalg.inv(R)
+		HRH = HR@self.H_m
+		Q_m = K.W@Q@np.conj(K.W).T
+
+		def f(t, w_t, P_t, z_t):
+			S_t = np.linalg.inv(np.linalg.inv(P_t) + HRH) # posterior covariance
+			w_t = w_t + S_t@HR@(z_t - self.H_m@w_t)
+			w_t = self.K.propagate(w_t)
+			P_t = self.K.propagate_cov(S_t) + Q_m
+			return w_t, P_t
+		self.f = f
+
+		self.w_t = K.to_modal(x0[:, np.newaxis].astype(complex))
+		self.P_t = K.W@np.conj(K.W).T
+
+	@property
+	def x_t(self):
+		return self.K.from_modal(self.w_t)
+
+	def __call__(self, z_t: np.ndarray):
+		''' Observe through filter ''' 
+		self.t += self.dt
+		self.w_t, self.P_t = self.f(self.t, self.w_t, self.P_t, z_t[:, np.newaxis])
+		x_t = np.squeeze(self.x_t)
+		err_t = z_t - x_t@self.H.T
+		return x_t.copy(), err_t
+
+if __name__ == '__main__':
+	import matplotlib.pyplot as plt
+
+	set_seed(6008)
+
+	dt = 1e-3
+	n = 20000
+	z = VanDerPol(dt, 0.1)
+	K = ModalKoopman(z.K.numpy(), r=6)
+	f = MDKF(z.obs.call_numpy(z.x0), K, z.H, z.Q + 1e-6*np.eye(z.ndim), z.R, dt)
+
+	hist_t = []
+	hist_z = []
+	hist_x = []
+	hist_err = []
+
+	for _ in range(n):
+		z_t = z()
+		x_t, err_t = f(z_t)
+		hist_z.append(z_t)
+		hist_t.append(z.t)
+		hist_x.append(x_t) 
+		hist_err.append(err_t)
+
+	hist_t = np.array(hist_t)
+	hist_z = np.array(hist_z)
+	hist_x = np.array(hist_x)
+	hist_err = np.array(hist_err)
+
+	fig, axs = plt.subplots(1, 3, figsize=(15, 5))
+	fig.suptitle(f'Modal KF ({K.r} modes)')
+	axs[0].plot(hist_z[:,0], hist_z[:,1], color='blue', label='obs')
+	axs[0].plot(hist_x[:,0], hist_x[:,1], color='orange', label='est')
+	axs[0].legend()
+	axs[0].set_title('System')
+	axs[1].plot(hist_t, hist_err[:,0])
+	axs[1].set_title('Axis 1 error')
+	axs[2].plot(hist_t, hist_err[:,1])
+	axs[2].set_title('Axis 2 error')
+
+	plt.show()
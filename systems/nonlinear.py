@@ -11,9 +11,29 @@ import pdb
 from utils import transferop_to_diff
 from totorch.utils import set_seed
 from totorch.features import PolynomialObservable
+from totorch.cache import CachedObservable, ModelCache, fingerprint
 import totorch.operators as op
 from totorch.predict import extrapolate
 
+def fit_model(name: str, sys: Callable, x0: np.ndarray, t_fit: np.ndarray, obs: CachedObservable, params: dict, cache: bool = True):
+	""" Simulate fit window and solve EDMD, or load the result from the on-disk model cache.
+
+	Cache key covers system name, parameter values sampled over the fit window, initial condition, fit window & dt, and observable definition.
+	"""
+	key = fingerprint(name, x0, t_fit[0], t_fit[-1], len(t_fit), obs.obs, {
+		p: np.array([f(t) for t in t_fit[::max(1, len(t_fit) // 1000)]], dtype=float) for p, f in params.items()
+	})
+	store = ModelCache()
+	model = store.load(key) if cache else None
+	if model is None:
+		x_fit = torch.from_numpy(solve_ivp(sys, [t_fit[0], t_fit[-1]], x0, t_eval=t_fit).y).float()
+		K = op.solve(x_fit, obs=obs)
+		if cache:
+			store.save(key, K=K.numpy(), x_fit=x_fit.numpy(), exponents=obs.exponents)
+		return x_fit, K
+	assert np.array_equal(model['exponents'], obs.exponents), 'Cached model has a different observable'
+	return torch.from_numpy(model['x_fit']), torch.from_numpy(model['K'])
+
 class HiddenProcess:
 	def __init__(self, x0: np.ndarray, sys: Callable, F: Callable, proj: Callable, dt: float, H: np.ndarray, var_v: float, ndim: int):
 		''' Arbitrary diff.eq with observation noise ''' 
@@ -43,7 +63,7 @@ class HiddenProcess:
 		return self.r.t
 
 class VanDerPol(HiddenProcess):
-	def __init__(self, dt: float, var_v: float, mu: Callable=None):
+	def __init__(self, dt: float, var_v: float, mu: Callable=None, cache: bool=True):
 		if mu == None:
 			mu = lambda t: 3.0
 		sys = lambda t, z: [z[1], mu(t)*(1-z[0]**2)*z[1] - z[0]]
@@ -51,16 +71,14 @@ class VanDerPol(HiddenProcess):
 
 		# Init features
 		p, d, k = 4, 2, 8
-		self.obs = PolynomialObservable(p, d, k)
+		self.obs = CachedObservable(PolynomialObservable(p, d, k))
 		proj = lambda x: self.obs.call_numpy(x)
 		H = np.eye(k)
 
 		# Fit linear model
 		a, b = 0, 20
 		self.t_fit = np.linspace(a, b, int(b/dt))
-		x_fit = solve_ivp(sys, [a, b], x0, t_eval=self.t_fit).y
-		self.x_fit = torch.from_numpy(x_fit).float()
-		self.K = op.solve(self.x_fit, obs=self.obs)
+		self.x_fit, self.K = fit_model('VanDerPol', sys, x0, self.t_fit, self.obs, {'mu': mu}, cache=cache)
 		assert not torch.isnan(self.K).any().item(), 'Got NaN in the model!'
 
 		# Use K as discrete-time model
@@ -93,7 +111,7 @@ class VanDerPol(HiddenProcess):
 		plt.show()
 
 class Lorenz(HiddenProcess):
-	def __init__(self, dt: float, var_v: float, sigma: Callable=None, beta: Callable=None, rho: Callable=None):
+	def __init__(self, dt: float, var_v: float, sigma: Callable=None, beta: Callable=None, rho: Callable=None, cache: bool=True):
 		if sigma is None: sigma = lambda t: 10
 		if beta is None: beta = lambda t: 2.667
 		if rho is None: rho = lambda t: 28
@@ -109,16 +127,14 @@ class Lorenz(HiddenProcess):
 
 		# Init features
 		p, d, k = 2, 3, 9
-		self.obs = PolynomialObservable(p, d, k)
+		self.obs = CachedObservable(PolynomialObservable(p, d, k))
 		proj = lambda x: self.obs.call_numpy(x)
 		H = np.eye(k)
 
 		# Fit linear model
 		a, b = 0, 30
 		self.t_fit = np.linspace(a, b, int(b/dt))
-		x_fit = solve_ivp(sys, [a, b], x0, t_eval=self.t_fit).y
-		self.x_fit = torch.from_numpy(x_fit).float()
-		self.K = op.solve(self.x_fit, obs=self.obs)
+		self.x_fit, self.K = fit_model('Lorenz', sys, x0, self.t_fit, self.obs, {'sigma': sigma, 'beta': beta, 'rho': rho}, cache=cache)
 		assert not torch.isnan(self.K).any().item(), 'Got NaN in the model!'
 
 		# Use K as discrete-time model
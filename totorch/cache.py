@@ -0,0 +1,218 @@
+"""Content-addressed caches for lifted features and fitted models.
+"""
+
+import os
+import torch
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+from totorch.features import Observable
+
+""" Fingerprints """
+
+def _update_hash(h, obj):
+	if isinstance(obj, torch.Tensor):
+		obj = obj.detach().cpu()
+		h.update(f'torch:{obj.dtype}:{tuple(obj.shape)}'.encode())
+		h.update(obj.contiguous().numpy().tobytes())
+	elif isinstance(obj, np.ndarray):
+		h.update(f'numpy:{obj.dtype}:{obj.shape}'.encode())
+		h.update(np.ascontiguousarray(obj).tobytes())
+	elif isinstance(obj, (list, tuple)):
+		h.update(f'{type(obj).__name__}:{len(obj)}'.encode())
+		for x in obj:
+			_update_hash(h, x)
+	elif isinstance(obj, dict):
+		h.update(f'dict:{len(obj)}'.encode())
+		for key in sorted(obj, key=repr):
+			_update_hash(h, key)
+			_update_hash(h, obj[key])
+	elif hasattr(obj, '__dict__'):
+		h.update(type(obj).__qualname__.encode())
+		for key in sorted(vars(obj)):
+			if not key.startswith('_'): # private attributes are derived state
+				h.update(key.encode())
+				_update_hash(h, vars(obj)[key])
+	else:
+		h.update(repr(obj).encode())
+
+def fingerprint(*objs):
+	"""Content hash of observables, tensors, arrays and plain values"""
+	h = hashlib.blake2b(digest_size=16)
+	for obj in objs:
+		_update_hash(h, obj)
+	return h.hexdigest()
+
+""" Caches """
+
+def _nbytes(x):
+	if isinstance(x, torch.Tensor):
+		return x.nelement() * x.element_size()
+	return x.nbytes
+
+class FeatureCache:
+	"""LRU cache of lifted feature matrices with byte-size eviction
+
+	Args:
+		max_bytes: (optional) memory budget
+		spill_dir: (optional) if provided, evicted entries are written here and reloaded on lookup
+	"""
+	def __init__(self, max_bytes: int = 1 << 30, spill_dir: str = None):
+		self.max_bytes = max_bytes
+		self.spill_dir = spill_dir
+		self.nbytes = 0
+		self._entries = OrderedDict()
+		if spill_dir is not None:
+			os.makedirs(spill_dir, exist_ok=True)
+
+	def _spill_path(self, key: str, numpy: bool):
+		return os.path.join(self.spill_dir, f'{key}.npy' if numpy else f'{key}.pt')
+
+	def _spill(self, key: str, value):
+		"""Write an evicted entry; arrays as .npy, tensors as .pt (so both reload with safe loaders)"""
+		numpy = isinstance(value, np.ndarray)
+		path = self._spill_path(key, numpy)
+		if not os.path.exists(path):
+			if numpy:
+				np.save(path, value)
+			else:
+				torch.save(value, path)
+
+	def _unspill(self, key: str):
+		if os.path.exists(self._spill_path(key, True)):
+			return np.load(self._spill_path(key, True))
+		if os.path.exists(self._spill_path(key, False)):
+			return torch.load(self._spill_path(key, False), weights_only=True)
+		return None
+
+	def get(self, key: str):
+		if key in self._entries:
+			self._entries.move_to_end(key)
+			return self._entries[key]
+		if self.spill_dir is not None:
+			value = self._unspill(key)
+			if value is not None:
+				self.put(key, value)
+			return value
+		return None
+
+	def put(self, key: str, value):
+		if key in self._entries:
+			self.nbytes -= _nbytes(self._entries.pop(key))
+		self._entries[key] = value
+		self.nbytes += _nbytes(value)
+		while self.nbytes > self.max_bytes and len(self._entries) > 0:
+			old_key, old_value = self._entries.popitem(last=False)
+			self.nbytes -= _nbytes(old_value)
+			if self.spill_dir is not None:
+				self._spill(old_key, old_value)
+
+	def clear(self):
+		self._entries.clear()
+		self.nbytes = 0
+
+default_cache = FeatureCache()
+
+class CachedObservable(Observable):
+	"""Observable whose evaluations are cached by content (observable definition, data, dtype)
+
+	Args:
+		obs: observable to wrap
+		cache: (optional) feature cache. If not provided, uses module-level `default_cache`.
+		min_bytes: (optional) inputs smaller than this are evaluated directly (e.g. single filter steps). 
+			The default admits fitting trajectories of a few thousand snapshots.
+
+	Note: inputs requiring grad are never cached. Cached results are shared; do not modify them in place.
+	"""
+	def __init__(self, obs: Observable, cache: FeatureCache = None, min_bytes: int = 1 << 14):
+		self.obs = obs
+		self.cache = default_cache if cache is None else cache
+		self.min_bytes = min_bytes
+		self._obs_key = fingerprint(obs)
+		super().__init__(obs.d, obs.k, obs.m)
+
+	def __getattr__(self, name):
+		# Only reached for attributes not defined on the wrapper (e.g. `psi`)
+		if name == 'obs':
+			raise AttributeError(name)
+		return getattr(self.obs, name)
+
+	def _cached(self, fn, X, domain: str):
+		if (isinstance(X, torch.Tensor) and X.requires_grad) or _nbytes(X) < self.min_bytes:
+			return fn(X)
+		key = fingerprint(self._obs_key, domain, X)
+		Z = self.cache.get(key)
+		if Z is None:
+			Z = fn(X)
+			if Z is X or (isinstance(Z, torch.Tensor) and Z._base is not None) or (isinstance(Z, np.ndarray) and Z.base is not None):
+				Z = Z.clone() if isinstance(Z, torch.Tensor) else Z.copy() # do not alias caller data
+			self.cache.put(key, Z)
+		return Z
+
+	def __call__(self, X: torch.Tensor):
+		return self._cached(self.obs, X, 'torch')
+
+	def call_numpy(self, X: np.ndarray, out: np.ndarray = None):
+		if out is not None: # in-place evaluation (e.g. `Koopman.apply`) is not cached
+			return self.obs.call_numpy(X, out=out)
+		return self._cached(self.obs.call_numpy, X, 'numpy')
+
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		return self.obs.derivative(X, dX)
+
+	def preimage(self, Z: torch.Tensor):
+		return self.obs.preimage(Z)
+
+""" Model cache """
+
+class ModelCache:
+	"""Persistent, content-addressed store of fitted models (dicts of numpy arrays) in .npz files
+
+	Args:
+		cache_dir: (optional) directory. Defaults to $LKF_CACHE_DIR, else ~/.cache/lkf.
+
+	Writes are atomic, so concurrent pool workers may share a cache directory.
+	"""
+	def __init__(self, cache_dir: str = None):
+		if cache_dir is None:
+			cache_dir = os.environ.get('LKF_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'lkf'))
+		self.cache_dir = cache_dir
+
+	def _path(self, key: str):
+		return os.path.join(self.cache_dir, f'{key}.npz')
+
+	def load(self, key: str):
+		"""Return dict of arrays stored under key, or None"""
+		try:
+			with np.load(self._path(key)) as f:
+				return {name: f[name] for name in f.files}
+		except (OSError, ValueError):
+			return None
+
+	def save(self, key: str, **arrays):
+		os.makedirs(self.cache_dir, exist_ok=True)
+		tmp = os.path.join(self.cache_dir, f'.{key}.{os.getpid()}.tmp.npz')
+		np.savez(tmp, **arrays)
+		os.replace(tmp, self._path(key))
+
+""" Tests """
+
+if __name__ == '__main__':
+	import tempfile
+	from totorch.features import PolynomialObservable
+
+	print('Feature cache spill test')
+	cache = FeatureCache(max_bytes=1, spill_dir=tempfile.mkdtemp())
+	arr, ten = np.random.randn(50), torch.randn(50)
+	cache.put('arr', arr)
+	cache.put('ten', ten)
+	assert len(cache._entries) == 0, 'entries over budget not evicted'
+	assert np.array_equal(cache.get('arr'), arr) and torch.equal(cache.get('ten'), ten), 'spilled entries not restored'
+
+	print('Cached observable test')
+	obs = CachedObservable(PolynomialObservable(3, 2, 6), cache=FeatureCache())
+	X = torch.randn((2, 20000)) # fitting trajectory, 160 KB
+	assert obs(X) is obs(X), 'fitting trajectory not cached'
+	assert torch.equal(obs(X), obs.obs(X)), 'cached features incorrect'
+	assert np.array_equal(obs.call_numpy(X.double().numpy()), obs.obs.call_numpy(X.double().numpy())), 'cached numpy features incorrect'
@@ -1,29 +1,41 @@
 """Gradient descent-based model predictive control solver"""
 
+import time
 import torch 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from tqdm import tqdm
 from scipy.integrate import ode
-from typing import Callable, Dict
+from typing import Callable, Dict, List
 
 from totorch.features import *
 from totorch.predict import extrapolate
+from totorch.control.qp_mpc import QuadraticCost, solve_qp_mpc, cached_prediction_matrices, stack_horizon, unstack_horizon, optimality_gap
 
 def solve_mpc(
 		t0: float, x0: torch.Tensor, dt: float, 
 		K: torch.Tensor, B: torch.Tensor, obs: Observable, cost: Callable, h: int,
 		umin: float = None, umax: float = None, lr: float = 0.1, loss_eps: float = 1e-4, unlift_every: bool = False,
+		checkpoint_every: int = None, solver: str = 'auto', state: Dict = None,
+		optimizer: str = 'sgd', max_iter: int = None, time_budget: float = None,
 	):
-	"""Solve a single step of the MPC problem via Koopman operator. Uses autograd + SGD to solve minimization problem.
+	"""Solve a single step of the MPC problem via Koopman operator. Uses autograd + a first-order or quasi-Newton optimizer 
+	with projection onto [umin, umax] to solve minimization problem, or an exact condensed QP (see `totorch.control.qp_mpc`) 
+	for quadratic costs with lifted-space prediction.
+
+	With `max_iter` and/or `time_budget` set, the solve is anytime: it stops at the cap or deadline and returns the best 
+	(lowest-cost) feasible input evaluated so far.
 
 	Args:
 		t0: start time
-		x0: initial condition (d x 1)
+		x0: initial condition (d), or d x b for a batch of b independent problems solved simultaneously
 		dt: time discretization delta
 		K: Koopman operator (d x d)
 		B: Control influence matrix (d x u) (see `totorch.operators.solve_with_control`) 
 		obs: Observable function
 		cost: convex cost function C : t, x, u -> R. (t, x, u are tensors of 2nd-dimension length h, denoting time, predicted system state, and control input, respectively)
+			For a batch, x and u carry a trailing batch dimension b and the cost should sum over problems (e.g. `QuadraticCost` with a d x h x b reference).
 		h: horizon 
 		umin: (optional) lower bound on control inputs
 		umax: (optional) upper bound on control inputs
@@ -31,16 +43,48 @@ def solve_mpc(
 		loss_eps: (optional) if change in loss is below this, exits
 		unlift_every: (optional) extrapolation method. By default uses faster but less accurate method. 
 			For reasonable `h` this should not matter. If performance is low, try setting True.
+		checkpoint_every: (optional) checkpoint rollout segments of this many steps to bound autograd memory for long horizons (see `extrapolate`)
+		solver: (optional) 'sgd', 'qp', or 'auto' (QP if `cost` is a `QuadraticCost`, `unlift_every` is False and the observable is memoryless; SGD otherwise)
+		state: (optional) warm-start state dict, read and updated in place. On entry, 'u' (u x h) and 'momentum' (u x h x 1, SGD only) 
+			initialize the solver if present. On exit, holds the solution 'u', optimizer 'momentum', and statistics 'n_iter', 'solve_time', 'loss', 
+			'deadline_miss' (solve exceeded `time_budget`) and 'gap' (optimality gap of the returned input, see `totorch.control.qp_mpc.optimality_gap`).
+		optimizer: (optional) 'sgd' (momentum), 'adam', or 'lbfgs' (strong Wolfe line search). Iterates are projected onto [umin, umax] after each step.
+		max_iter: (optional) maximum optimizer steps (for 'lbfgs', each step runs up to 5 inner iterations, or 1 with `time_budget`; for 'qp', Newton iterations)
+		time_budget: (optional) wall-clock budget in seconds. Checked between steps: the solve stops when another step, at the mean step time so far, 
+			would exceed it. The first step always runs; overruns are reported as deadline misses. On the QP path, bounds the projected Newton iterations.
 
 	Returns:
-		u_opt: optimal inputs 
-		x_pred: predicted system response 
+		u_opt: optimal inputs (u x h, or u x h x b)
+		x_pred: predicted system response (d x h, or d x h x b)
 	"""
-	x0 = x0.detach().requires_grad_()
-	dim_u = B.shape[1] # dimension of control input
-	u = torch.zeros((dim_u, h, 1))
+	assert solver in ('auto', 'sgd', 'qp'), f'Unknown solver {solver}'
+	assert optimizer in ('sgd', 'adam', 'lbfgs'), f'Unknown optimizer {optimizer}'
+	use_qp = isinstance(cost, QuadraticCost) and not unlift_every and obs.m == 1
+	assert solver != 'qp' or use_qp, 'QP solver requires a QuadraticCost, unlift_every=False and a memoryless observable'
+	if solver != 'sgd' and use_qp:
+		qp_args = {} if max_iter is None else {'max_iter': max_iter}
+		return solve_qp_mpc(t0, x0, dt, K, B, obs, cost, h, umin=umin, umax=umax, state=state, time_budget=time_budget, **qp_args)
+
+	t_start = time.perf_counter()
+	batched = len(x0.shape) == 2
+	x0 = x0.detach() if batched else x0.detach().unsqueeze(1) # d x b
+	x0.requires_grad_()
+	dim_u, d, b = B.shape[1], obs.d, x0.shape[1] # dimension of control input, state, batch
+	if state is not None and state.get('u') is not None:
+		u = state['u'].detach().clone()
+		u = u if batched else u.unsqueeze(2)
+	else:
+		u = torch.zeros((dim_u, h, b))
 	u = torch.nn.Parameter(u)
-	opt = torch.optim.SGD([u], lr=lr, momentum=0.98)
+	if optimizer == 'sgd':
+		opt = torch.optim.SGD([u], lr=lr, momentum=0.98)
+		if state is not None and state.get('momentum') is not None:
+			opt.state[u]['momentum_buffer'] = state['momentum'].clone()
+	elif optimizer == 'adam':
+		opt = torch.optim.Adam([u], lr=lr)
+	else:
+		# Under a time budget, one inner iteration per step so the deadline is checked between iterations
+		opt = torch.optim.LBFGS([u], lr=1., max_iter=5 if time_budget is None else 1, history_size=10, line_search_fn='strong_wolfe')
 
 	window = torch.Tensor([t0 + dt*i for i in range(h)])
 	loss, prev_loss = torch.Tensor([float('inf')]), torch.Tensor([0.])
@@ -50,28 +94,121 @@ def solve_mpc(
 			return u_in.clamp(min=umin, max=umax)
 		return u_in
 
-	while torch.abs(loss - prev_loss).item() > loss_eps:
-		prev_loss = loss
-		x_pred = extrapolate(x0.unsqueeze(1), K, obs, h-1, B=B, u=apply_clamp(u), unlift_every=unlift_every)
-		loss = cost(window, x_pred, u) 
+	def project(u_in):
+		# Straight-through projection: clamped value, identity gradient (clamp's gradient vanishes at the bounds)
+		return u_in + (apply_clamp(u_in) - u_in).detach()
+
+	if not unlift_every and obs.m == 1:
+		# Condensed prediction x = Phi z0 + Gamma u, reused across iterations and solves
+		Phi, Gamma = cached_prediction_matrices(K, B, obs, h)
+		free_response = Phi@obs(x0.detach()).to(Phi)
+		predict = lambda u_in: unstack_horizon(free_response + Gamma@stack_horizon(u_in).to(Gamma), d, h)
+	else:
+		predict = lambda u_in: extrapolate(x0.unsqueeze(1), K, obs, h-1, B=B, u=u_in, unlift_every=unlift_every, checkpoint_every=checkpoint_every)
+
+	evaluated = {} # first evaluation of each step, at the step's (feasible) starting input
+	def closure():
 		opt.zero_grad()
+		x_pred = predict(project(u)) # d x h x b
+		loss = cost(window, x_pred if batched else x_pred[:, :, 0], u)
 		loss.backward()
-		opt.step()
+		if not evaluated:
+			evaluated.update(x_pred=x_pred.detach(), grad=u.grad.clone())
+		# Inputs held at a bound by their gradient are frozen (active set), so optimizer steps and curvature pairs stay in the box
+		with torch.no_grad():
+			if umin is not None:
+				u.grad[(u <= umin) & (u.grad > 0)] = 0.
+			if umax is not None:
+				u.grad[(u >= umax) & (u.grad < 0)] = 0.
+		return loss
+
+	# Iterates are projected onto the box, so every evaluated input is feasible; keep the best one with its prediction and gradient
+	u.data = apply_clamp(u.data)
+	n_iter, best, best_loss = 0, None, float('inf')
+	t_loop = time.perf_counter()
+	while torch.abs(loss - prev_loss).item() > loss_eps:
+		if n_iter > 0 and max_iter is not None and n_iter >= max_iter:
+			break
+		if n_iter > 0 and time_budget is not None:
+			now = time.perf_counter()
+			if now - t_start + (now - t_loop) / n_iter > time_budget: # next step (at the mean step time) would overrun
+				break
+		n_iter += 1
+		prev_loss = loss
+		u_prev = u.data.clone()
+		evaluated.clear()
+		loss = opt.step(closure).detach() # loss at u_prev
 		u.data = apply_clamp(u.data)
+		if best is None or loss.item() < best_loss:
+			best, best_loss = (u_prev, evaluated['x_pred'], evaluated['grad']), loss.item()
+
+	u.data, x_pred, grad = best
+	if not batched:
+		x_pred = x_pred[:, :, 0]
+
+	u_opt = u.data if batched else u.data[:,:,0]
+	if state is not None:
+		solve_time = time.perf_counter() - t_start
+		state.update(
+			u=u_opt, momentum=opt.state[u].get('momentum_buffer') if optimizer == 'sgd' else None, 
+			n_iter=n_iter, solve_time=solve_time, loss=best_loss,
+			deadline_miss=time_budget is not None and solve_time > time_budget, 
+			gap=optimality_gap(u.data, grad, umin, umax),
+		)
+	return u_opt, x_pred
 
-	return u.data[:,:,0], x_pred
+def shift_state(state: Dict, n: int):
+	"""Shift a warm-start state (see `solve_mpc`) forward by `n` applied inputs, in place. 
+	The input guess repeats its last entry; the momentum buffer is zero-padded.
+	"""
+	if state.get('u') is not None:
+		u = state['u']
+		state['u'] = torch.cat((u[:, n:], u[:, -1:].repeat_interleave(n, 1)), 1)
+	if state.get('momentum') is not None:
+		m = state['momentum']
+		state['momentum'] = torch.cat((m[:, n:], torch.zeros_like(m[:, :n])), 1)
+	return state
+
+_worker_plant = None
+
+def _init_worker(plant: Callable, integrator: str):
+	"""Pipeline worker initializer. The worker is forked, so the plant (which may be a closure) is inherited rather than pickled."""
+	global _worker_plant
+	_worker_plant = (plant, integrator)
+
+def _integrate_period(dt: float, t: float, Y: np.ndarray, U: np.ndarray):
+	"""Integrate the worker's plant instances over one control period with a fresh integrator each, from states Y (d x b) at time t, 
+	applying inputs U (u x n x b) for `dt` each. Returns the states after each input (d x n x b).
+	"""
+	plant, integrator = _worker_plant
+	out = np.empty((Y.shape[0], U.shape[1], Y.shape[1]))
+	for i in range(Y.shape[1]):
+		r = ode(plant).set_integrator(integrator)
+		r.set_initial_value(Y[:, i], t)
+		for j in range(U.shape[1]):
+			r.set_f_params(U[:, j, i])
+			r.integrate(r.t + dt)
+			out[:, j, i] = r.y
+	return out
 
 def mpc_loop(
 		plant: Callable, x0: torch.Tensor, dt: float, n_iter: int,
 		K: torch.Tensor, B: torch.Tensor, obs: Observable, cost: Callable, h: int, 
 		umin: float = None, umax: float = None, mpc_args: Dict = {}, n_apply: int = 1, integrator: str = 'dop853', 
+		warm_start: bool = False, stats: List = None, pipeline: bool = False,
 	):
 	"""Run the model-predictive control loop with feedback from a provided plant.
 
+	By default, solving and plant integration alternate. With `pipeline`, the plant integrates the current inputs in a worker process 
+	while the next problem is solved from the state the last solve predicted after `n_apply` steps (delay compensation), so each control 
+	period costs roughly max(solve time, plant time) rather than their sum. The next solve therefore uses a predicted rather than measured 
+	initial condition; the prediction error is reported in `stats`. The worker restarts the integrator from the measured state each period, 
+	so only states and inputs cross the process boundary.
+
 	Args:
 		plant: true ODE system function of the form required by `scipy.integrate.ode`: https://docs.scipy.org/doc/scipy/reference/generated/scipy.integrate.ode.html . Used to provide actual feedback to the controller.
 			Note: the only parameter to the plant should be control input. Please see `totorch.examples.control` for an example plant definition.
-		x0: initial condition (d x 1)
+		x0: initial condition (d), or d x b to control b plant instances (e.g. scenarios of a robustness sweep) in lockstep with one batched solve per step
 		dt: discretization time delta
 		n_iter: number of steps to simulate plant w/ control
 		K: Koopman operator (d x d)
@@ -84,38 +221,169 @@ def mpc_loop(
 		mpc_args: (optional) arguments to MPC solver, see `solve_mpc`
 		n_apply: (optional) number of control inputs to apply after each solution. Default 1 (standard MPC).
 		integrator: scipy.ode integrator https://docs.scipy.org/doc/scipy/reference/generated/scipy.integrate.ode.html
+		warm_start: (optional) initialize each solve from the previous solution shifted by `n_apply` (and its optimizer state). Default False.
+		stats: (optional) if provided, a dict of solver statistics ('t', 'n_iter', 'solve_time', 'loss', 'deadline_miss', 'gap') is appended per solve.
+			In pipelined mode, solves after the first also report 'delay_error', the distance between predicted and measured initial condition.
+		pipeline: (optional) overlap each solve with integration of the previous inputs in a forked worker process. 
+			Needs a spare CPU core to pay off; per-period process communication costs well under a millisecond.
 
 	Returns:
 		hist_t: time history
-		hist_u: control input history
-		hist_x: plant response history
+		hist_u: control input history (T x u, or T x u x b)
+		hist_x: plant response history (d x T, or d x T x b)
 
 	"""
 	assert n_apply < h, 'horizon should be larger than n_apply'
 
 	dim_u = B.shape[1] # dimension of control input
+	batched = len(x0.shape) == 2
 	hist_t = [0.]
-	hist_u = [torch.zeros(dim_u,)]
+	hist_u = [torch.zeros((dim_u, x0.shape[1]) if batched else (dim_u,))]
 	hist_x = [x0]
 	t = 0.
 
-	r = ode(plant).set_integrator(integrator)
-	r.set_initial_value(x0.numpy()).set_f_params(hist_u[0])
+	plants = []
+	for i in range(x0.shape[1] if batched else 1):
+		r = ode(plant).set_integrator(integrator)
+		r.set_initial_value(x0[:, i].numpy() if batched else x0.numpy()).set_f_params(hist_u[0][:, i] if batched else hist_u[0])
+		plants.append(r)
 
-	for _ in tqdm(range(n_iter), desc='MPC'):
-		u_opt, _ = solve_mpc(t, x0, dt, K, B, obs, cost, h, umin=umin, umax=umax, **mpc_args)
+	def advance(u_opt: torch.Tensor, t: float):
+		"""Integrate the plants over the first `n_apply` inputs; returns (t, u, x) per step"""
+		steps = []
 		for j in range(n_apply):
 			u_cur = u_opt[:, j] 
-			r.set_f_params(u_cur)
-			r.integrate(r.t + dt)
+			for i, r in enumerate(plants):
+				r.set_f_params(u_cur[:, i] if batched else u_cur)
+				r.integrate(r.t + dt)
 			t += dt
-			x0 = torch.Tensor(r.y) # update MPC initial condition with plant output
-			hist_t.append(t)
-			hist_u.append(u_cur)
-			hist_x.append(x0)
+			x = torch.stack([torch.Tensor(r.y) for r in plants], 1) if batched else torch.Tensor(plants[0].y)
+			steps.append((t, u_cur, x))
+		return steps
 
-	hist_t, hist_u, hist_x = torch.Tensor(hist_t), torch.stack(hist_u), torch.stack(hist_x).t()
+	state = {}
+	def solve(t: float, x: torch.Tensor):
+		nonlocal state
+		if not warm_start:
+			state = {}
+		u_opt, x_pred = solve_mpc(t, x, dt, K, B, obs, cost, h, umin=umin, umax=umax, state=state, **mpc_args)
+		entry = {'t': t, **{key: state[key] for key in ('n_iter', 'solve_time', 'loss', 'deadline_miss', 'gap')}}
+		shift_state(state, n_apply)
+		return u_opt, x_pred, entry
+
+	def record(steps):
+		for t_j, u_j, x_j in steps:
+			hist_t.append(t_j)
+			hist_u.append(u_j)
+			hist_x.append(x_j)
+		return steps[-1][0], steps[-1][2] # update MPC initial condition with plant output
+
+	if not pipeline:
+		for _ in tqdm(range(n_iter), desc='MPC'):
+			u_opt, _, entry = solve(t, x0)
+			if stats is not None:
+				stats.append(entry)
+			t, x0 = record(advance(u_opt, t))
+	else:
+		with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork'), initializer=_init_worker, initargs=(plant, integrator)) as pool:
+			u_opt, x_pred, entry = solve(t, x0)
+			for k in tqdm(range(n_iter), desc='MPC (pipelined)'):
+				U = u_opt[:, :n_apply].detach().numpy()
+				Y = x0.numpy()
+				plant_states = pool.submit(_integrate_period, dt, t, Y if batched else Y[:, None], U if batched else U[:, :, None])
+				if k < n_iter - 1:
+					# Delay compensation: solve the next problem from the state predicted after n_apply steps
+					x_hat = x_pred[:, n_apply]
+					u_next, x_next, entry_next = solve(t + n_apply*dt, x_hat)
+				if stats is not None:
+					stats.append(entry)
+				X = torch.Tensor(plant_states.result())
+				steps = []
+				for j in range(n_apply):
+					t += dt
+					steps.append((t, u_opt[:, j], X[:, j] if batched else X[:, j, 0]))
+				t, x0 = record(steps)
+				if k < n_iter - 1:
+					entry_next['delay_error'] = torch.norm(x0 - x_hat.to(x0)).item()
+					u_opt, x_pred, entry = u_next, x_next, entry_next
+
+	hist_t, hist_u, hist_x = torch.Tensor(hist_t), torch.stack(hist_u), torch.stack(hist_x).transpose(0, 1)
 	return hist_t, hist_u, hist_x
 
 
 
+
+""" Tests """
+
+if __name__ == '__main__':
+	from totorch.utils import set_seed
+	from totorch.control.qp_mpc import condensed_hessian
+	set_seed(9001)
+
+	print('Projected first-order MPC test')
+	d, d_u, h, dt = 3, 1, 12, 0.1
+	K = torch.from_numpy(0.95*np.linalg.qr(np.random.randn(d, d))[0])
+	B = torch.randn((d, d_u), dtype=torch.float64)
+	obs = Observable(d, d, 1)
+	reference = lambda t: torch.stack([torch.sin(t), torch.cos(t), 0*t]).double()
+	cost = QuadraticCost(torch.eye(d, dtype=torch.float64), 0.1*torch.eye(d_u, dtype=torch.float64), reference=reference)
+	umin, umax = -0.5, 0.5
+	x0 = torch.randn(d, dtype=torch.float64)
+	qp_state = {}
+	u_qp, _ = solve_qp_mpc(0., x0, dt, K, B, obs, cost, h, umin=umin, umax=umax, state=qp_state)
+	assert (u_qp.abs() >= umax - 1e-9).any(), 'test problem should have active bounds'
+
+	# Exact gradient of the condensed objective, H U + G
+	Phi, _ = cached_prediction_matrices(K, B, obs, h)
+	H, GQ = condensed_hessian(K, B, obs, cost, h, ridge=0.)
+	G = 2*GQ@(Phi@x0.unsqueeze(1) - stack_horizon(reference(torch.Tensor([dt*i for i in range(h)])).unsqueeze(2)))
+	for u in (u_qp, torch.full_like(u_qp, umax), torch.zeros_like(u_qp)):
+		state = {'u': u}
+		solve_mpc(0., x0, dt, K, B, obs, cost, h, umin=umin, umax=umax, solver='sgd', state=state, max_iter=1)
+		U = stack_horizon(u.unsqueeze(2))
+		gap = optimality_gap(U, H@U + G, umin, umax)
+		assert abs(state['gap'] - gap) <= 1e-8 * max(1., gap), 'first-order optimality gap does not use the gradient at the bounds'
+		if u is u_qp:
+			assert state['gap'] < 1e-6 and abs(state['gap'] - qp_state['gap']) < 1e-6, 'optimality gap at the QP optimum should vanish'
+
+	for optimizer, lr in (('sgd', 0.01), ('adam', 0.05), ('lbfgs', 1.)):
+		state = {}
+		solve_mpc(0., x0, dt, K, B, obs, cost, h, umin=umin, umax=umax, solver='sgd', optimizer=optimizer, lr=lr, loss_eps=1e-12, max_iter=2000, state=state)
+		assert abs(state['loss'] - qp_state['loss']) < 1e-3 * qp_state['loss'], f'{optimizer} does not reach the QP optimum'
+		assert state['gap'] < 0.1, f'{optimizer} optimality gap too large'
+
+	print('Anytime MPC test')
+	budget = 0.05
+	for solver in ('sgd', 'qp'):
+		state = {}
+		u_any, x_any = solve_mpc(0., x0, dt, K, B, obs, cost, h, umin=umin, umax=umax, solver=solver, lr=1e-4, loss_eps=0., max_iter=10**6, time_budget=budget, state=state)
+		assert state['solve_time'] < 2*budget, f'{solver} solve overran its time budget'
+		window = torch.Tensor([dt*i for i in range(h)])
+		assert abs(cost(window, x_any, u_any).item() - state['loss']) < 1e-6 * state['loss'], 'reported loss is not that of the returned input'
+	assert state['gap'] < 1e-6, 'QP path should converge within budget'
+
+	print('Unbounded MPC loop test')
+	A_c = -torch.eye(d, dtype=torch.float64) + 0.5*torch.randn((d, d), dtype=torch.float64)
+	K_c = torch.linalg.matrix_exp(A_c*dt)
+	B_c = torch.linalg.solve(A_c, (K_c - torch.eye(d, dtype=torch.float64))@B) # zero-order hold, so the model is exact
+	plant = lambda t, z, u: A_c.numpy()@z + B[:, 0].numpy()*float(u[0])
+	for solver in ('qp', 'sgd'):
+		stats = []
+		_, hist_u, hist_x = mpc_loop(plant, torch.ones(d), dt, 5, K_c, B_c, obs, cost, h, mpc_args={'solver': solver, 'max_iter': 50}, stats=stats)
+		assert torch.isfinite(hist_x).all() and all(np.isfinite(s['gap']) for s in stats), f'unbounded {solver} MPC loop failed'
+		state = {}
+		solve_mpc(0., torch.ones(d), dt, K_c, B_c, obs, cost, h, solver=solver, state=state)
+		assert np.isfinite(state['gap']), f'unbounded {solver} optimality gap not reported'
+
+	print('Pipelined MPC loop test')
+	trajectories = {}
+	for pipeline in (False, True):
+		stats = []
+		trajectories[pipeline] = mpc_loop(plant, torch.ones(d), dt, 10, K_c, B_c, obs, cost, h, umin=umin, umax=umax, n_apply=2, stats=stats, pipeline=pipeline)
+	(t_sync, u_sync, x_sync), (t_pipe, u_pipe, x_pipe) = trajectories[False], trajectories[True]
+	assert torch.allclose(t_sync, t_pipe) and x_sync.shape == x_pipe.shape, 'pipelined loop time grid differs from synchronous loop'
+	assert (x_pipe - x_sync).abs().max() < 1e-4, 'pipelined loop trajectory differs from synchronous loop'
+	assert all(s['delay_error'] < 1e-4 for s in stats[1:]), 'delay compensation error too large'
+	X0 = torch.stack((torch.ones(d), -torch.ones(d)), 1)
+	_, _, x_batch = mpc_loop(plant, X0, dt, 10, K_c, B_c, obs, cost, h, umin=umin, umax=umax, n_apply=2, pipeline=True)
+	assert (x_batch[:, :, 0] - x_pipe).abs().max() < 1e-5, 'batched pipelined loop differs from single run'
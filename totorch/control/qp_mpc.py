@@ -0,0 +1,277 @@
+"""Condensed quadratic-program model predictive control solver"""
+
+import time
+import torch
+import numpy as np
+from typing import Callable, Dict
+
+from totorch.features import *
+from totorch.utils import TensorCache
+
+_predictions = TensorCache()
+
+class QuadraticCost:
+	"""Quadratic tracking cost sum_t (x_t - r(t))^T Q (x_t - r(t)) + u_t^T R u_t
+
+	Args:
+		Q: state weight (d x d), positive semidefinite
+		R: input weight (d_u x d_u), positive semidefinite
+		reference: (optional) reference signal r : t (length h) -> d x h. If not provided, regulates to zero.
+
+	Callable as `cost(t, x, u)`, so it may be used with any MPC solver; `solve_mpc` uses the condensed QP solver for it when possible.
+	"""
+	def __init__(self, Q: torch.Tensor, R: torch.Tensor, reference: Callable = None):
+		self.Q = Q
+		self.R = R
+		self.reference = reference
+
+	def ref(self, t: torch.Tensor):
+		if self.reference is None:
+			return torch.zeros((self.Q.shape[0], len(t)))
+		return self.reference(t)
+
+	def __call__(self, t: torch.Tensor, x: torch.Tensor, u: torch.Tensor):
+		r = self.ref(t)
+		e = x - r.reshape(tuple(r.shape) + (1,)*(len(x.shape) - len(r.shape)))
+		return (e * torch.einsum('ij,j...->i...', self.Q.to(e), e)).sum() + (u * torch.einsum('ij,j...->i...', self.R.to(u), u)).sum()
+
+def stack_horizon(X: torch.Tensor):
+	"""Stack a batch of trajectories n x h x b time-major into (h*n) x b"""
+	n, h, b = X.shape
+	return X.permute(1, 0, 2).reshape(h*n, b)
+
+def unstack_horizon(X: torch.Tensor, n: int, h: int):
+	"""Inverse of `stack_horizon`"""
+	return X.view(h, n, -1).permute(1, 0, 2)
+
+def prediction_matrices(K: torch.Tensor, B: torch.Tensor, C: torch.Tensor, h: int):
+	"""Condensed prediction matrices for z_{j+1} = K z_j + B u_j, x_j = C z_j.
+
+	Args:
+		K: Koopman operator (k x k)
+		B: Control influence matrix (k x d_u)
+		C: linear preimage (d x k)
+		h: horizon
+
+	Returns:
+		Phi: (h*d) x k
+		Gamma: (h*d) x (h*d_u)
+		such that the stacked predictions [x_0; ...; x_{h-1}] = Phi z_0 + Gamma [u_0; ...; u_{h-1}] (the last input does not affect the horizon).
+	"""
+	d, d_u = C.shape[0], B.shape[1]
+	CK = [C]
+	for _ in range(1, h):
+		CK.append(CK[-1]@K)
+	CKB = [M@B for M in CK]
+	Phi = torch.cat(CK, 0)
+	Gamma = torch.zeros((h*d, h*d_u), dtype=K.dtype, device=K.device)
+	for j in range(1, h):
+		for l in range(j):
+			Gamma[j*d:(j+1)*d, l*d_u:(l+1)*d_u] = CKB[j-1-l]
+	return Phi, Gamma
+
+def cached_prediction_matrices(K: torch.Tensor, B: torch.Tensor, obs: Observable, h: int):
+	"""Prediction matrices (see `prediction_matrices`) for a memoryless observable with linear preimage, 
+	cached per (K, B, obs, h) and rebuilt when K or B is modified in place or replaced.
+	"""
+	def build():
+		C = obs.preimage(torch.eye(obs.k, dtype=K.dtype, device=K.device))
+		return prediction_matrices(K, B, C, h)
+	return _predictions.get((K, B), build, h, id(obs))
+
+def condensed_hessian(K: torch.Tensor, B: torch.Tensor, obs: Observable, cost: QuadraticCost, h: int, ridge: float = 1e-9):
+	"""Regularized QP Hessian 2 (Gamma^T Q_bar Gamma + R_bar) and Gamma^T Q_bar, cached per (K, B, Q, R, obs, h)"""
+	def build():
+		_, Gamma = cached_prediction_matrices(K, B, obs, h)
+		Q_bar = torch.kron(torch.eye(h, dtype=K.dtype), cost.Q.to(K.dtype))
+		R_bar = torch.kron(torch.eye(h, dtype=K.dtype), cost.R.to(K.dtype))
+		GQ = Gamma.t()@Q_bar
+		H = 2*(GQ@Gamma + R_bar)
+		H = H + ridge * (H.trace() / H.shape[0] + 1.) * torch.eye(H.shape[0], dtype=H.dtype)
+		return H, GQ
+	return _predictions.get((K, B, cost.Q, cost.R), build, h, id(obs), ridge)
+
+def optimality_gap(u: torch.Tensor, grad: torch.Tensor, umin: float = None, umax: float = None):
+	"""Optimality gap of a feasible input u given the cost gradient.
+
+	For a bounded box, the Frank-Wolfe gap max_{umin <= v <= umax} <grad, u - v>, an upper bound on suboptimality for convex costs.
+	Otherwise the norm of the projected gradient u - P(u - grad) (the gradient norm if unbounded), zero exactly at stationary points.
+	"""
+	if umin is not None and umax is not None:
+		return ((grad*u).sum() - torch.where(grad > 0, grad*umin, grad*umax).sum()).item()
+	if umin is None and umax is None:
+		return torch.norm(grad).item()
+	return torch.norm(u - (u - grad).clamp(min=umin, max=umax)).item()
+
+def box_qp(
+		H: torch.Tensor, g: torch.Tensor, lo: torch.Tensor, hi: torch.Tensor, max_iter: int = 100, tol: float = 1e-8, u0: torch.Tensor = None,
+		deadline: float = None,
+	):
+	"""Solve min 1/2 u^T H u + g^T u s.t. lo <= u <= hi by projected Newton with an active set.
+
+	Args:
+		g: linear term (n), or n x b for b problems sharing H and the box. Problems are solved simultaneously, each with its own 
+			active set (Newton steps are batched solves of H with the active rows and columns replaced by identity) and line search.
+		u0: (optional) initial guess (e.g. shifted previous solution), shaped like g. If not provided, starts from the clamped unconstrained minimizer.
+		deadline: (optional) `time.perf_counter()` time by which to return. Iterates are feasible, so the solve stops early with the 
+			current iterate when another iteration, at the mean iteration time so far, would pass it.
+
+	Returns:
+		u: minimizer, shaped like g
+		n_iter: number of Newton iterations (maximum over the batch)
+	"""
+	batched = len(g.shape) == 2
+	G = g if batched else g.unsqueeze(1)
+	lo, hi = lo.unsqueeze(1), hi.unsqueeze(1)
+	clamp = lambda U: torch.max(torch.min(U, hi), lo)
+	f = lambda U: ((0.5*(H@U) + G)*U).sum(0)
+	U = torch.linalg.solve(H, -G) if u0 is None else (u0 if batched else u0.unsqueeze(1)).to(H)
+	U = clamp(U)
+	running = torch.ones(U.shape[1], dtype=torch.bool, device=U.device) # problems still iterating
+	n_iter, t_start = 0, time.perf_counter()
+	while n_iter < max_iter:
+		if n_iter > 0 and deadline is not None:
+			now = time.perf_counter()
+			if now + (now - t_start) / n_iter > deadline:
+				break
+		grad = H@U + G
+		running &= torch.norm(U - clamp(U - grad), dim=0) > tol # projected gradient (KKT) test
+		if not running.any():
+			break
+		free = ~(((U <= lo) & (grad > 0)) | ((U >= hi) & (grad < 0)))
+		mask = free.t().to(H)
+		M = mask.unsqueeze(2) * H * mask.unsqueeze(1) + torch.diag_embed(1 - mask)
+		step = torch.linalg.solve(M, -(mask*grad.t())).t()
+		step = torch.where(free.any(0), step, -grad) # all bounds active: projected gradient step
+		f_u = f(U)
+		alpha = torch.ones_like(f_u)
+		U_new, searching = U, running.clone()
+		while True: # backtrack along projection arc
+			U_try = clamp(U + alpha*step)
+			accept = searching & ((f(U_try) <= f_u) | (alpha < 1e-10))
+			U_new = torch.where(accept, U_try, U_new)
+			searching &= ~accept
+			if not searching.any():
+				break
+			alpha = torch.where(searching, alpha/2, alpha)
+		n_iter += 1
+		running &= torch.norm(U_new - U, dim=0) > tol
+		U = U_new
+		if not running.any():
+			break
+	return (U if batched else U[:, 0]), n_iter
+
+def solve_qp_mpc(
+		t0: float, x0: torch.Tensor, dt: float,
+		K: torch.Tensor, B: torch.Tensor, obs: Observable, cost: QuadraticCost, h: int,
+		umin: float = None, umax: float = None, max_iter: int = 100, tol: float = 1e-8, ridge: float = 1e-9,
+		state: Dict = None, time_budget: float = None,
+	):
+	"""Solve a single step of the MPC problem exactly as a box-constrained QP.
+
+	Requires lifted-space (`unlift_every=False`) prediction, a memoryless observable with linear preimage, and a `QuadraticCost`.
+	Arguments and returns as in `totorch.control.gradient_mpc.solve_mpc`, plus
+		max_iter: (optional) maximum projected Newton iterations
+		tol: (optional) convergence tolerance
+		ridge: (optional) relative Tikhonov regularization of the Hessian (inputs without effect on the horizon are otherwise undetermined)
+		state: (optional) warm-start state, see `solve_mpc`. Only 'u' is used as initial guess.
+		time_budget: (optional) wall-clock budget in seconds. Projected Newton stops early with its current (feasible) iterate when another 
+			iteration would exceed it (see `box_qp`); overruns are reported as deadline misses.
+
+	Batched problems (x0 of shape d x b, reference of shape d x h x b) share the condensed matrices and are solved as one batched box QP.
+	"""
+	t_start = time.perf_counter()
+	assert obs.m == 1, 'QP solver requires a memoryless observable'
+	dim_u, d = B.shape[1], obs.d
+	batched = len(x0.shape) == 2
+	x0 = x0.detach() if batched else x0.detach().unsqueeze(1)
+	Phi, Gamma = cached_prediction_matrices(K, B, obs, h)
+	H, GQ = condensed_hessian(K, B, obs, cost, h, ridge=ridge)
+	free_response = Phi@obs(x0).to(K.dtype)
+
+	window = torch.Tensor([t0 + dt*i for i in range(h)])
+	r = cost.ref(window).to(K.dtype)
+	if len(r.shape) == 2:
+		r = r.unsqueeze(2)
+	G = 2*GQ@(free_response - stack_horizon(r)) # b linear terms
+
+	lo = torch.full((h*dim_u,), -np.inf if umin is None else umin, dtype=K.dtype)
+	hi = torch.full((h*dim_u,), np.inf if umax is None else umax, dtype=K.dtype)
+	U0 = None
+	if state is not None and state.get('u') is not None:
+		U0 = stack_horizon(state['u'] if batched else state['u'].unsqueeze(2))
+	deadline = None if time_budget is None else t_start + time_budget
+	U, n_iter = box_qp(H, G, lo, hi, max_iter=max_iter, tol=tol, u0=U0, deadline=deadline)
+
+	u_opt = unstack_horizon(U, dim_u, h)
+	x_pred = unstack_horizon(free_response + Gamma@U, d, h)
+	if not batched:
+		u_opt, x_pred = u_opt[:, :, 0], x_pred[:, :, 0]
+	if state is not None:
+		solve_time = time.perf_counter() - t_start
+		state.update(
+			u=u_opt, momentum=None, n_iter=n_iter, solve_time=solve_time, loss=cost(window, x_pred, u_opt).item(),
+			deadline_miss=time_budget is not None and solve_time > time_budget, gap=optimality_gap(U, H@U + G, umin, umax),
+		)
+	return u_opt, x_pred
+
+""" Tests """
+
+if __name__ == '__main__':
+	from scipy.optimize import lsq_linear
+	from totorch.utils import set_seed
+	set_seed(9001)
+
+	def bvls(H, g, lo, hi):
+		"""Reference: min 1/2 u^T H u + g^T u = 1/2 ||L^T u + L^{-1} g||^2 + const over the box, by bounded-variable least squares"""
+		L = np.linalg.cholesky(H)
+		return lsq_linear(L.T, -np.linalg.solve(L, g), bounds=(lo, hi), method='bvls', tol=1e-12).x
+
+	print('Box QP test')
+	for n, bound in ((6, 0.3), (20, 1.), (20, np.inf)):
+		A = torch.randn((n, n), dtype=torch.float64)
+		H = A@A.t() + 0.1*torch.eye(n, dtype=torch.float64)
+		g = 3*torch.randn(n, dtype=torch.float64)
+		lo, hi = torch.full((n,), -bound, dtype=torch.float64), torch.full((n,), bound, dtype=torch.float64)
+		u, _ = box_qp(H, g, lo, hi)
+		u_ref = bvls(H.numpy(), g.numpy(), lo.numpy(), hi.numpy())
+		assert np.abs(u.numpy() - u_ref).max() < 1e-6, f'box QP (n={n}, bound={bound}) does not match BVLS'
+		u_warm, n_warm = box_qp(H, g, lo, hi, u0=u)
+		assert torch.allclose(u_warm, u) and n_warm <= 1, 'box QP warm start at the optimum should not iterate'
+		G = 3*torch.randn((n, 5), dtype=torch.float64)
+		U, n_batch = box_qp(H, G, lo, hi)
+		singles = [box_qp(H, G[:, i], lo, hi) for i in range(G.shape[1])]
+		assert torch.allclose(U, torch.stack([u_i for u_i, _ in singles], 1), atol=1e-10), 'batched box QP differs from single solves'
+		assert n_batch == max(n_i for _, n_i in singles), 'batched box QP iteration count incorrect'
+
+	print('Condensed QP MPC test')
+	d, d_u, h, dt = 3, 1, 12, 0.1
+	K = torch.from_numpy(0.95*np.linalg.qr(np.random.randn(d, d))[0])
+	B = torch.randn((d, d_u), dtype=torch.float64)
+	obs = Observable(d, d, 1)
+	reference = lambda t: torch.stack([torch.sin(t), torch.cos(t), 0*t]).double()
+	cost = QuadraticCost(torch.eye(d, dtype=torch.float64), 0.1*torch.eye(d_u, dtype=torch.float64), reference=reference)
+	umin, umax = -0.5, 0.5
+
+	# Reference condensed problem from an explicit rollout, independent of `prediction_matrices`
+	def rollout(x0, U):
+		x, X = x0, []
+		for j in range(h):
+			X.append(x)
+			x = K.numpy()@x + B.numpy()@U[j*d_u:(j+1)*d_u]
+		return np.concatenate(X)
+	r = stack_horizon(reference(torch.Tensor([dt*i for i in range(h)])).unsqueeze(2))[:, 0].numpy()
+	A_ref = np.stack([rollout(np.zeros(d), e) for e in np.eye(h*d_u)], 1)
+	x0s = torch.randn((d, 4), dtype=torch.float64)
+	state = {}
+	U, X = solve_qp_mpc(0., x0s, dt, K, B, obs, cost, h, umin=umin, umax=umax, state=state)
+	for i in range(x0s.shape[1]):
+		x0 = x0s[:, i].numpy()
+		u_ref = lsq_linear(np.vstack((A_ref, np.sqrt(0.1)*np.eye(h*d_u))), np.concatenate((r - rollout(x0, np.zeros(h*d_u)), np.zeros(h*d_u))),
+			bounds=(umin, umax), method='bvls', tol=1e-12).x
+		assert np.abs(stack_horizon(U[:, :, i:i+1])[:, 0].numpy() - u_ref).max() < 1e-5, 'condensed QP MPC does not match BVLS'
+		assert np.abs(stack_horizon(X[:, :, i:i+1])[:, 0].numpy() - rollout(x0, u_ref)).max() < 1e-5, 'condensed QP MPC prediction incorrect'
+		u_i, x_i = solve_qp_mpc(0., x0s[:, i], dt, K, B, obs, cost, h, umin=umin, umax=umax)
+		assert torch.allclose(u_i, U[:, :, i]) and torch.allclose(x_i, X[:, :, i]), 'batched QP MPC differs from single solves'
+	assert (U.abs() >= umax - 1e-9).any(), 'test problem should have active bounds'
+	assert state['gap'] < 1e-6, 'optimality gap at the QP solution should vanish'
@@ -3,7 +3,11 @@
 
 import torch
 import random
+import operator
+import functools
 import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
 
 """ Observables """
 
@@ -30,6 +34,15 @@ class Observable:
 		"""
 		return X
 
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		"""Evaluate time derivative of observable along a vector field (chain rule)
+
+		Args:
+			X: state snapshot d (state dimension) x N (trajectory length)
+			dX: state time derivative d (state dimension) x N (trajectory length)
+		"""
+		return dX
+
 	def preimage(self, Z: torch.Tensor):
 		"""Obtain preimage
 
@@ -43,28 +56,116 @@ class ComposedObservable(Observable):
 
 	Args:
 		seq: list of observables to be composed from left (innermost) to right (outermost). Must have matching interleaving dimensions.
+		chunk: (optional) if provided, evaluate in time chunks of this many snapshots, so intermediate features take O(chunk * k) memory.
 	"""
-	def __init__(self, seq: list):
+	def __init__(self, seq: list, chunk: int = None):
 		assert len(seq) > 0, 'At least one observable must be provided'
 		for i in range(len(seq)-1):
 			assert seq[i].k == seq[i+1].d, f'Output dimension of observable {i} does not match input dimension of observable {i+1}'
+		assert chunk is None or chunk > 0
 
 		self.seq = seq
+		self.chunk = chunk
 		d, k, m = seq[0].d, seq[-1].k, np.prod([obs.m for obs in seq])
 		super().__init__(d, k, m)
 
 	def __call__(self, X: torch.Tensor):
-		Z = X
-		for obs in self.seq:
-			Z = obs(Z)
+		if self.chunk is None or X.shape[1] <= self.chunk:
+			Z = X
+			for obs in self.seq:
+				Z = obs(Z)
+			return Z
+
+		chunks = self.iter_chunks(X, self.chunk)
+		if X.requires_grad:
+			return torch.cat(tuple(chunks), 1)
+		n = X.shape[1] - sum(obs.m - 1 for obs in self.seq)
+		Z, i = None, 0
+		for Z_c in chunks:
+			if Z is None:
+				Z = torch.empty((Z_c.shape[0], n), dtype=Z_c.dtype, device=Z_c.device)
+			Z[:, i:i+Z_c.shape[1]] = Z_c
+			i += Z_c.shape[1]
 		return Z
 
+	def _plan(self):
+		"""Group observables into stages: consecutive memoryless (m = 1) observables are fused into one stage"""
+		stages = []
+		for obs in self.seq:
+			if obs.m == 1 and len(stages) > 0 and stages[-1][1] == 1:
+				stages[-1][0].append(obs)
+			else:
+				stages.append(([obs], obs.m))
+		return stages
+
+	def iter_chunks(self, X: torch.Tensor, chunk: int):
+		"""Evaluate observable over consecutive time chunks of X
+
+		Args:
+			X: state snapshot d (state dimension) x N (trajectory length)
+			chunk: number of input snapshots per chunk
+
+		Yields:
+			consecutive k x (chunk length) blocks of the output, which concatenate to `self(X)`.
+
+		Stages with memory m > 1 carry their last m-1 input columns into the next chunk, so every feature is computed exactly once.
+		"""
+		stages = self._plan()
+		carry = [None for _ in stages]
+		for s in range(0, X.shape[1], chunk):
+			Z = X[:, s:s+chunk]
+			for i, (seq, m) in enumerate(stages):
+				if m > 1:
+					if carry[i] is not None:
+						Z = torch.cat((carry[i].t(), Z.t()), 0).t() # time-major, embedded without further copies
+					carry[i] = Z[:, max(0, Z.shape[1]-(m-1)):]
+					if Z.shape[1] < m:
+						Z = None
+						break
+				for obs in seq:
+					Z = obs(Z)
+			if Z is not None:
+				yield Z
+
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		Z, dZ = X, dX
+		for obs in self.seq:
+			Z, dZ = obs(Z), obs.derivative(Z, dZ)
+		return dZ
+
 	def preimage(self, Z: torch.Tensor):
 		X = Z
 		for obs in reversed(self.seq):
 			X = obs.preimage(X)
 		return X
 
+class ProjectedObservable(Observable):
+	"""Observable followed by linear projection onto an r-dimensional basis (e.g. from `totorch.operators.solve_reduced`)
+
+	Args:
+		obs: observable
+		U: orthonormal basis k (observable dimension) x r (reduced dimension)
+	"""
+	def __init__(self, obs: Observable, U: torch.Tensor):
+		assert U.shape[0] == obs.k, 'Basis dimension must match observable dimension'
+		self.obs = obs
+		self.U = U
+		super().__init__(obs.d, U.shape[1], obs.m)
+
+	def __call__(self, X: torch.Tensor):
+		return self.U.t().to(X)@self.obs(X)
+
+	def call_numpy(self, X: np.ndarray, out: np.ndarray = None):
+		return np.matmul(self.U.t().double().numpy(), self.obs.call_numpy(X), out=out)
+
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		return self.U.t().to(X)@self.obs.derivative(X, dX)
+
+	def preimage(self, Z):
+		if isinstance(Z, np.ndarray):
+			return self.obs.preimage(self.U.double().numpy()@Z)
+		return self.obs.preimage(self.U.to(Z)@Z)
+
 class DelayObservable(Observable):
 	"""Delay-coordinate embedding 
 	
@@ -80,14 +181,60 @@ class DelayObservable(Observable):
 		super().__init__(d, k, m)
 
 	def __call__(self, X: torch.Tensor):
+		"""Hankel embedding, returned as a strided view of X (no copy for time-major or 1-dimensional X).
+
+		Note: the result aliases X; row block i holds X shifted by i.
+		"""
 		n = X.shape[1]
 		assert n >= self.tau + 1
-		Z = torch.cat(tuple(X[:, i:n-self.tau+i] for i in range(self.tau+1)), 0)
-		return Z
+		if self.d == 1:
+			strides = (X.stride(1), X.stride(1))
+		elif X.stride(1) == self.d * X.stride(0):
+			strides = X.stride()
+		else:
+			X = X.t().contiguous().t() # single time-major copy (d x N with stride (1, d))
+			strides = X.stride()
+		return X.as_strided((self.k, n - self.tau), strides, X.storage_offset())
+
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		return self(dX) # delay embedding is linear
 
 	def preimage(self, Z: torch.Tensor):
 		return Z[:self.d]
 
+class DelayBuffer:
+	"""Rolling (tau+1)-deep buffer for online delay embedding (e.g. inside filters)
+
+	Args:
+		obs: delay observable
+		dtype: (optional) buffer data type
+		device: (optional) buffer device
+
+	Samples are written twice into a time-major ring of length 2(tau+1), so the current window is always a contiguous slice and is lifted without copying.
+	"""
+	def __init__(self, obs: DelayObservable, dtype=torch.float32, device='cpu'):
+		self.obs = obs
+		self.n = obs.tau + 1
+		self._buf = torch.zeros((2*self.n, obs.d), dtype=dtype, device=device)
+		self._pos = 0
+		self.count = 0
+
+	def push(self, x: torch.Tensor):
+		"""Append state snapshot x (d,) to the buffer"""
+		self._buf[self._pos] = x
+		self._buf[self._pos + self.n] = x
+		self._pos = (self._pos + 1) % self.n
+		self.count += 1
+
+	@property
+	def full(self):
+		return self.count >= self.n
+
+	def __call__(self):
+		"""Delay-embedded observation k x 1 of the latest tau+1 snapshots (view into buffer)"""
+		assert self.full, f'Buffer requires {self.n} snapshots, got {self.count}'
+		return self._buf[self._pos:self._pos + self.n].view(self.obs.k, 1)
+
 class PolynomialObservable(Observable):
 	"""Observable consisting of randomly chosen polynomials up to degree d
 
@@ -130,43 +277,165 @@ class PolynomialObservable(Observable):
 			if key not in self.psi: # sample without replacement
 				self.psi[key] = None
 
+		# Compiled dictionary: row i holds the exponents of psi term i, factored as (term, power) pairs
+		self.exponents = np.array(list(self.psi.keys()), dtype=np.int64)
+		self._factors = [[(term, a) for term, a in enumerate(key) if a > 0] for key in self.psi]
+		self._pairs = sorted(set(f for factors in self._factors for f in factors))
+		self._dpairs = sorted(set(self._pairs) | set((term, a-1) for term, a in self._pairs if a > 1))
+		self._scratch = None
+
 		super().__init__(d, k, 1)
 
+	def _powers(self, X, power, pairs):
+		"""Each needed power x_term^a, computed once"""
+		return {(term, a): X[term] if a == 1 else power(X[term], a) for term, a in pairs}
+
 	def __call__(self, X: torch.Tensor):
+		# Factors are multiplied in the same order as `psi` keys, so results match per-monomial evaluation.
+		powers = self._powers(X, torch.pow, self._pairs)
 		if X.requires_grad:
-			Z = [torch.ones((X.shape[1],), device=X.device) for _ in range(self.k)]
-			for i, key in enumerate(self.psi.keys()):
-				for term, power in enumerate(key):
-					if power > 0:
-						Z[i] = Z[i] * torch.pow(X[term], power)
-			return torch.stack(Z)
-		else:
-			Z = torch.ones((self.k, X.shape[1]), device=X.device)
-			for i, key in enumerate(self.psi.keys()):
-				for term, power in enumerate(key):
-					if power > 0:
-						Z[i] *= torch.pow(X[term], power)
-			return Z
+			return torch.stack([functools.reduce(operator.mul, (powers[f] for f in factors)) for factors in self._factors])
+		Z = torch.empty((self.k,) + tuple(X.shape[1:]), dtype=X.dtype, device=X.device)
+		for i, factors in enumerate(self._factors):
+			if len(factors) == 1:
+				Z[i].copy_(powers[factors[0]])
+			else:
+				torch.mul(powers[factors[0]], powers[factors[1]], out=Z[i])
+				for f in factors[2:]:
+					Z[i].mul_(powers[f])
+		return Z
 
-	def call_numpy(self, X: np.ndarray):
-		if len(X.shape) == 1:
-			Z = np.ones(self.k)
-		else:
-			Z = np.ones((self.k, X.shape[1]))
-		for i, key in enumerate(self.psi.keys()):
-			for term, power in enumerate(key):
-				if power > 0:
-					Z[i] *= np.power(X[term], power)
+	def call_numpy(self, X: np.ndarray, out: np.ndarray = None):
+		"""Numpy variant of `__call__`, writing into `out` (allocated if not provided).
+
+		`out` may alias X as its leading d rows (the full state observable, which is rewritten with itself), as in `Koopman.apply`.
+		Higher powers go to a scratch buffer reused across calls of the same shape.
+		"""
+		shape = X.shape[1:]
+		if self._scratch is None or self._scratch.shape[1:] != shape or self._scratch.dtype != X.dtype:
+			self._scratch = np.empty((len(self._pairs),) + shape, dtype=X.dtype)
+		powers = {(term, a): X[term] if a == 1 else np.power(X[term], a, out=self._scratch[j, ...]) for j, (term, a) in enumerate(self._pairs)}
+		Z = np.empty((self.k,) + shape) if out is None else out
+		for i, factors in enumerate(self._factors):
+			Z[i] = powers[factors[0]]
+			for f in factors[1:]:
+				Z[i] *= powers[f] # accumulates in float64, like per-monomial evaluation
 		return Z
 
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		powers = self._powers(X, torch.pow, self._dpairs)
+		dZ = torch.zeros((self.k,) + tuple(X.shape[1:]), dtype=X.dtype, device=X.device)
+		for i, factors in enumerate(self._factors):
+			for term, a in factors:
+				dz = a * dX[term] if a == 1 else a * powers[(term, a-1)] * dX[term]
+				for f in factors:
+					if f[0] != term:
+						dz = dz * powers[f]
+				dZ[i] += dz
+		return dZ
+
 	def preimage(self, Z: torch.Tensor): 
 		return Z[:self.d]
 
-class GaussianObservable(Observable):
-	"""TODO"""
-	def __init__(self, sigma: float):
+class RandomFourierObservable(Observable):
+	"""Random Fourier features approximating a shift-invariant kernel (scalable alternative to kernel DMD)
+
+	Args:
+		d: state dimension
+		k: observable dimension (full state observable + k-d random features)
+		sigma: kernel bandwidth
+		kernel: (optional) spectral distribution to sample, 'gaussian' (see `GaussianKernel`) or 'laplacian' (see `LaplacianKernel`)
+		seed: (optional) seed for sampling features. If not provided, uses the Torch random state.
+
+	Based on https://people.eecs.berkeley.edu/~brecht/papers/07.rah.rec.nips.pdf
+	"""
+	def __init__(self, d: int, k: int, sigma: float, kernel: str = 'gaussian', seed: int = None):
+		assert k > d, "Basis dimension must be larger than full state observable"
+		assert kernel in ('gaussian', 'laplacian'), f'Unknown kernel {kernel}'
 		self.sigma = sigma
-		raise Exception('Not implemented')
+		self.kernel = kernel
+		self.seed = seed
+
+		gen = torch.Generator()
+		if seed is None:
+			gen.manual_seed(torch.randint(2**31, (1,)).item())
+		else:
+			gen.manual_seed(seed)
+		n = k - d
+		W = torch.randn((n, d), generator=gen, dtype=torch.float64) / sigma
+		if kernel == 'laplacian':
+			W = W / torch.randn((n, 1), generator=gen, dtype=torch.float64).abs() # multivariate Cauchy
+		# Kept in float64: heavy-tailed (Cauchy) frequencies make float32 phases W x + b inaccurate
+		self.W = W
+		self.b = 2 * np.pi * torch.rand((n, 1), generator=gen, dtype=torch.float64)
+		self.scale = np.sqrt(2 / n)
+
+		super().__init__(d, k, 1)
+
+	def _phase(self, X: torch.Tensor):
+		"""W x + b in float64"""
+		return self.W.to(X.device)@X.double() + self.b.to(X.device)
+
+	def __call__(self, X: torch.Tensor):
+		return torch.cat((X, (self.scale * torch.cos(self._phase(X))).to(X.dtype)), 0)
+
+	def call_numpy(self, X: np.ndarray, out: np.ndarray = None):
+		"""Numpy variant of `__call__`, writing into `out` (allocated if not provided). `out` may alias X as its leading d rows."""
+		W, b = self.W.numpy(), self.b.numpy()
+		if len(X.shape) == 1:
+			b = b[:, 0]
+		if out is None:
+			return np.concatenate((X, self.scale * np.cos(W@X + b)), 0)
+		out[:self.d] = X
+		Z = np.matmul(W, X, out=out[self.d:])
+		Z += b
+		np.cos(Z, out=Z)
+		Z *= self.scale
+		return out
+
+	def derivative(self, X: torch.Tensor, dX: torch.Tensor):
+		dZ = -self.scale * torch.sin(self._phase(X)) * (self.W.to(X.device)@dX.double())
+		return torch.cat((dX, dZ.to(X.dtype)), 0)
+
+	def preimage(self, Z: torch.Tensor):
+		return Z[:self.d]
+
+class GaussianObservable(RandomFourierObservable):
+	"""Random Fourier features for the Gaussian kernel (see `RandomFourierObservable`)"""
+	def __init__(self, d: int, k: int, sigma: float, seed: int = None):
+		super().__init__(d, k, sigma, kernel='gaussian', seed=seed)
+
+class NystromObservable(Observable):
+	"""Nystrom approximation of a kernel feature map from landmark snapshots
+
+	Args:
+		kernel: positive-definite kernel
+		C: landmark snapshots d (state dimension) x m (# landmarks)
+		eps: (optional) relative eigenvalue cutoff for the inverse square root of the landmark gramian
+
+	Features are W^{-1/2} k(C, x), with W = k(C, C), so inner products approximate the kernel.
+	The preimage is a linear regression from features to state (see `fit_preimage`).
+	"""
+	def __init__(self, kernel, C: torch.Tensor, eps: float = 1e-8):
+		self.kernel = kernel
+		self.C = C
+		evals, V = torch.linalg.eigh(kernel.gramian(C, C).double())
+		keep = evals > eps * evals.max()
+		self.W_isqrt = ((V[:, keep] / evals[keep].sqrt())@V[:, keep].t()).to(C.dtype)
+		self.P = None
+		super().__init__(C.shape[0], C.shape[1], 1)
+
+	def __call__(self, X: torch.Tensor):
+		return self.W_isqrt.to(X)@self.kernel.gramian(self.C.to(X), X)
+
+	def fit_preimage(self, X: torch.Tensor):
+		"""Least-squares map P from features to state over snapshots X (d x N)"""
+		Z = self(X)
+		self.P = X@Z.t()@torch.pinverse(Z@Z.t())
+
+	def preimage(self, Z: torch.Tensor):
+		assert self.P is not None, 'Preimage not fitted (see `fit_preimage`)'
+		return self.P.to(Z)@Z
 
 """ Kernels """
 
@@ -179,22 +448,55 @@ class Kernel:
 		pass
 
 	def gramian(self, X: torch.Tensor, Y: torch.Tensor):
-		"""Compute gramian (correlation matrix)"""
+		"""Compute gramian (correlation matrix)
+
+		Args:
+			X: d x N snapshot matrix
+			Y: d x M snapshot matrix
+
+		Returns:
+			N x M gramian
+		"""
 		return X.t()@Y
 
-class GaussianKernel(Kernel):
+class RadialKernel(Kernel):
+	"""Kernel k(x, y) = f(||x - y||). Subclasses define the profile f and the radius beyond which f < tol."""
+	def profile(self, D):
+		raise NotImplementedError
+
+	def radius(self, tol: float):
+		raise NotImplementedError
+
+	def gramian(self, X: torch.Tensor, Y: torch.Tensor):
+		return self.profile(torch.cdist(X.t(), Y.t(), p=2))
+
+	def gramian_sparse(self, X: torch.Tensor, Y: torch.Tensor, tol: float = 1e-8):
+		"""Sparse gramian (scipy CSR, N x M) keeping only pairs within `radius(tol)`, found with a KD-tree"""
+		tree_X = cKDTree(X.t().detach().cpu().double().numpy())
+		tree_Y = cKDTree(Y.t().detach().cpu().double().numpy())
+		pairs = tree_X.sparse_distance_matrix(tree_Y, self.radius(tol), output_type='ndarray')
+		G = sparse.coo_matrix((self.profile(pairs['v']), (pairs['i'], pairs['j'])), shape=(X.shape[1], Y.shape[1]))
+		return G.tocsr()
+
+class GaussianKernel(RadialKernel):
 	def __init__(self, sigma: float):
 		self.sigma = sigma
 
-	def gramian(self, X: torch.Tensor, Y: torch.Tensor):
-		return torch.exp(-torch.pow(torch.cdist(X, Y, p=2), 2)/(2*self.sigma**2))
+	def profile(self, D):
+		return (D**2 / (-2*self.sigma**2)).exp() if isinstance(D, torch.Tensor) else np.exp(-D**2/(2*self.sigma**2))
+
+	def radius(self, tol: float):
+		return self.sigma * np.sqrt(2*np.log(1/tol))
 
-class LaplacianKernel(Kernel):
+class LaplacianKernel(RadialKernel):
 	def __init__(self, sigma: float):
 		self.sigma = sigma
 
-	def gramian(self, X: torch.Tensor, Y: torch.Tensor):
-		return torch.exp(-torch.cdist(X, Y, p=2)/self.sigma)
+	def profile(self, D):
+		return (-D/self.sigma).exp() if isinstance(D, torch.Tensor) else np.exp(-D/self.sigma)
+
+	def radius(self, tol: float):
+		return self.sigma * np.log(1/tol)
 
 class PolynomialKernel(Kernel):
 	"""Polynomial kernel
@@ -221,6 +523,20 @@ if __name__ == '__main__':
 	Y = obs(X)
 	Z = obs.preimage(Y)
 	assert (X == Z).all().item(), 'poly preimage incorrect'
+	Y_ref = torch.ones((k, X.shape[1]))
+	for i, key in enumerate(obs.psi.keys()):
+		for term, power in enumerate(key):
+			if power > 0:
+				Y_ref[i] *= torch.pow(X[term], power)
+	assert (Y == Y_ref).all().item(), 'vectorized poly evaluation incorrect'
+	assert (obs(X.requires_grad_()) == Y_ref).all().item(), 'vectorized poly evaluation (grad) incorrect'
+	X_np = X.detach().numpy()
+	Y_ref_np = np.ones((k, X_np.shape[1]))
+	for i, key in enumerate(obs.psi.keys()):
+		for term, power in enumerate(key):
+			if power > 0:
+				Y_ref_np[i] *= np.power(X_np[term], power)
+	assert np.array_equal(obs.call_numpy(X_np), Y_ref_np), 'vectorized poly evaluation (numpy) incorrect'
 
 	print('Delay obs. test')
 	d, tau, n = 3, 3, 6
@@ -232,6 +548,37 @@ if __name__ == '__main__':
 	Z = obs.preimage(Y)
 	print('Z: ', Z)
 	assert (X[:, :Z.shape[1]] == Z).all().item(), 'delay preimage incorrect'
+	Y_ref = torch.cat(tuple(X[:, i:n-tau+i] for i in range(tau+1)), 0)
+	assert (Y == Y_ref).all().item(), 'delay embedding incorrect'
+	assert (obs(X.t().contiguous().t()) == Y_ref).all().item(), 'delay embedding (time-major) incorrect'
+	buf = DelayBuffer(obs)
+	for i in range(n):
+		buf.push(X[:, i])
+		if buf.full:
+			assert (buf().view(-1) == Y_ref[:, i-tau]).all().item(), 'delay buffer incorrect'
+
+	print('Random Fourier obs. test')
+	d, n, sigma = 3, 20, 2.0
+	X = torch.randn((d, n))
+	D = torch.cdist(X.t(), X.t())
+	for kernel, G in (('gaussian', torch.exp(-D**2/(2*sigma**2))), ('laplacian', torch.exp(-D/sigma))):
+		obs = RandomFourierObservable(d, d + 20000, sigma, kernel=kernel, seed=9001)
+		Z = obs(X)[d:]
+		assert (Z.t()@Z - G).abs().max().item() < 0.05, f'{kernel} random features do not approximate kernel'
+		assert (obs.preimage(obs(X)) == X).all().item(), 'random Fourier preimage incorrect'
+		assert np.allclose(obs.call_numpy(X.numpy()), obs(X).numpy(), atol=1e-5), 'random Fourier numpy evaluation incorrect'
+
+	print('Kernel test')
+	X = torch.randn((3, 7))
+	for kernel in (Kernel(), GaussianKernel(1.0), LaplacianKernel(1.0), PolynomialKernel(1.0, 2)):
+		assert kernel.gramian(X, X[:, :4]).shape == (7, 4), 'gramian shape incorrect'
+	for kernel in (GaussianKernel(0.5), LaplacianKernel(0.5)):
+		G = kernel.gramian(X, X[:, :4]).numpy()
+		G_sp = kernel.gramian_sparse(X, X[:, :4], tol=1e-3).toarray()
+		assert np.abs(G - G_sp).max() < 1e-3, 'sparse gramian incorrect'
+	obs = NystromObservable(GaussianKernel(1.0), X)
+	Z = obs(X)
+	assert torch.allclose(Z.t()@Z, GaussianKernel(1.0).gramian(X, X), atol=1e-4), 'Nystrom features incorrect'
 
 	print('Composed obs. test')
 	p, d, tau = 3, 5, 2
@@ -244,4 +591,7 @@ if __name__ == '__main__':
 	print(Y)
 	Z = obs.preimage(Y)
 	print(Z)
-	assert (X[:, :Z.shape[1]] == Z).all().item(), 'composed preimage incorrect'
\ No newline at end of file
+	assert (X[:, :Z.shape[1]] == Z).all().item(), 'composed preimage incorrect'
+	for chunk in (1, 2, 4):
+		obs_chunked = ComposedObservable([obs1, obs2], chunk=chunk)
+		assert torch.allclose(obs_chunked(X), Y), 'chunked composed evaluation incorrect'
\ No newline at end of file
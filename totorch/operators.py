@@ -2,19 +2,31 @@
 """
 
 import torch
+import multiprocessing
+import scipy.linalg as linalg
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sparse_linalg
+from collections import deque
 from typing import Callable, List
 
 from totorch.features import *
 
 class Koopman:
-	''' Intended for use in numpy land ''' 
-	def __init__(self, K: np.ndarray, obs: Observable, transpose=False):
+	''' Intended for use in numpy land 
+
+	The effective operator K + offset is cached in preallocated buffers (shared with `K_torch` and the transpose `T`)
+	and only recomputed after `set_offset`/`zero_offset`. `K` has the promoted dtype of K + offset; `K_torch` keeps the dtype of K.
+	''' 
+	def __init__(self, K: np.ndarray, obs: Observable, transpose=False, _state: dict = None):
 		self._K = K
-		self.K_torch = torch.from_numpy(K)
 		self.obs = obs
 		self.transpose = transpose
-		self.offset0 = np.zeros(K.shape)
-		self.offset = self.offset0
+		if _state is None:
+			offset0 = np.zeros(K.shape)
+			_state = {'offset0': offset0, 'offset': offset0, 'buffers': {}, 'fresh': set(), 'views': {}}
+		_state['views'][transpose] = self
+		self._state = _state
+		self.offset0 = _state['offset0']
 
 	def __matmul__(self, x: np.ndarray):
 		if self.transpose:
@@ -23,32 +35,105 @@ class Koopman:
 			return self.obs.call_numpy(self.obs.preimage(self.K@x))
 
 	def __rmatmul__(self, x: np.ndarray):
-		print('called!')
 		if self.transpose:
 			return self.obs.call_numpy(self.obs.preimage(x@self.K.T))
 		else:
 			return self.obs.call_numpy(self.obs.preimage((x@self.K).T)).T
 
-	def torch_dot(self, x: torch.Tensor):
-		return self.obs(self.obs.preimage(self.K_torch@x))
+	def apply(self, x: np.ndarray, out: np.ndarray = None):
+		"""In-place variant of `self @ x` (non-transposed): writes K x into `out` (allocated if not provided) and re-projects it there.
+
+		The re-projection is allocation-free for observables whose `call_numpy` accepts `out` aliasing its input (polynomial, random Fourier).
+		"""
+		assert not self.transpose, 'In-place apply is defined for the non-transposed operator'
+		out = np.matmul(self.K, x, out=out)
+		return self.obs.call_numpy(self.obs.preimage(out), out=out)
+
+	def torch_dot(self, x: torch.Tensor, out: torch.Tensor = None):
+		"""Torch variant of `self @ x` (uses the effective operator, including offset)"""
+		z = torch.matmul(self.K_torch, x, out=out)
+		return self.obs(self.obs.preimage(z))
 
 	@property
 	def T(self):
-		return Koopman(self.K, self.obs, transpose=(not self.transpose))
+		# Transpose shares the cached effective operator; created once
+		views = self._state['views']
+		if (not self.transpose) not in views:
+			Koopman(self._K, self.obs, transpose=(not self.transpose), _state=self._state)
+		return views[not self.transpose]
+
+	def _effective(self, dtype):
+		state = self._state
+		if dtype not in state['buffers']:
+			buf = np.empty(self._K.shape, dtype=dtype)
+			state['buffers'][dtype] = (buf, torch.from_numpy(buf))
+		if dtype not in state['fresh']:
+			np.add(self._K, state['offset'], out=state['buffers'][dtype][0], casting='same_kind')
+			state['fresh'].add(dtype)
+		return state['buffers'][dtype]
 
 	@property
 	def K(self):
-		return self._K + self.offset
+		return self._effective(np.result_type(self._K, self.offset))[0]
+
+	@property
+	def K_torch(self):
+		return self._effective(self._K.dtype)[1]
+
+	@property
+	def offset(self):
+		return self._state['offset']
 
 	def set_offset(self, offset: np.ndarray):
-		self.offset = offset
+		self._state['offset'] = offset
+		self._state['fresh'].clear()
 
 	def zero_offset(self):
-		self.offset = self.offset0
+		if self._state['offset'] is not self.offset0:
+			self._state['offset'] = self.offset0
+			self._state['fresh'].clear()
 
 	def re_project(self, x: np.ndarray):
 		return self.obs.call_numpy(self.obs.preimage(x))
 
+class ModalKoopman:
+	"""Koopman operator in its eigenbasis, for diagonal propagation in numpy land.
+
+	Args:
+		K: Koopman operator (k x k)
+		r: (optional) number of retained modes. Fastest-decaying modes (smallest |eigenvalue|) are truncated.
+			Rounded up if truncation would split a complex-conjugate pair.
+
+	Modal coordinates w relate to observables z by z = V w, w = W z. Propagation is w -> lam * w (O(r))
+	and modal covariance propagation is elementwise (O(r^2)).
+	"""
+	def __init__(self, K: np.ndarray, r: int = None):
+		evals, V = np.linalg.eig(K)
+		order = np.argsort(-np.abs(evals), kind='stable')
+		if r is None or r >= K.shape[0]:
+			r = K.shape[0]
+		elif np.iscomplex(evals[order[r-1]]) and np.isclose(evals[order[r]], np.conj(evals[order[r-1]])):
+			r += 1 # last retained mode opens a conjugate pair; keep its partner
+		idx = order[:r]
+		self.r = r
+		self.lam = evals[idx]
+		self.V = V[:, idx]
+		self.W = np.linalg.inv(V)[idx]
+
+	def to_modal(self, z: np.ndarray):
+		return self.W@z
+
+	def from_modal(self, w: np.ndarray):
+		return np.real(self.V@w)
+
+	def propagate(self, w: np.ndarray):
+		"""Advance modal state (r x N) by one step"""
+		return self.lam[:, np.newaxis] * w
+
+	def propagate_cov(self, P: np.ndarray):
+		"""Advance modal covariance (r x r) by one step, i.e. lam P lam^H"""
+		return self.lam[:, np.newaxis] * P * np.conj(self.lam)[np.newaxis, :]
+
 """ Snapshot generation """ 
 
 def prep_snapshots(data: torch.Tensor, obs: Observable = None):
@@ -118,25 +203,217 @@ def solve(data: torch.Tensor, koopman: bool = True, obs: Observable = None):
 	Based on https://arxiv.org/pdf/1712.01572
 	"""
 	X, Y = prep_snapshots(data, obs=obs)
+	return solve_snapshots(X, Y, koopman=koopman)
+
+def solve_snapshots(X: torch.Tensor, Y: torch.Tensor, koopman: bool = True):
+	"""Pseudoinverse solution from snapshot matrices (see `solve`, `select_snapshots`)"""
 	if koopman:
 		return Y@X.t()@torch.pinverse(X@X.t())
 	else:
 		return X@Y.t()@torch.pinverse(X@X.t())
 
-def solve_kernel(data: torch.Tensor, kernel: Kernel, koopman: bool = True):
+def _n_pairs(data: torch.Tensor, obs: Observable = None):
+	"""Number of snapshot pairs `prep_snapshots` would produce"""
+	m = 1 if obs is None else obs.m
+	return (data.shape[0] if len(data.shape) == 3 else 1) * (data.shape[-1] - m)
+
+def _lift_pairs_at(data: torch.Tensor, idx: torch.Tensor, obs: Observable = None):
+	"""Snapshot pairs idx (indices into `prep_snapshots` output), lifting only their (m+1)-step windows"""
+	m = 1 if obs is None else obs.m
+	offsets = torch.arange(m+1)
+	if len(data.shape) == 3:
+		per = data.shape[2] - m
+		segs = data[(idx // per).unsqueeze(1), :, (idx % per).unsqueeze(1) + offsets].permute(2, 0, 1) # d x n x (m+1)
+	else:
+		segs = data[:, idx.unsqueeze(1) + offsets]
+	flat = segs.reshape(segs.shape[0], -1)
+	Z = flat if obs is None else obs(flat) # column p is the window starting at flat[:, p]
+	starts = torch.arange(len(idx)) * (m+1)
+	return Z[:, starts], Z[:, starts+1]
+
+def _leverage_map(X: torch.Tensor, N: int, eps: float = 1e-10):
+	"""M with ||M x||^2 = x^T G^+ x, G = (N / s) X X^T estimated from s sample snapshots X; and rank(G)"""
+	evals, V = torch.linalg.eigh((N / X.shape[1]) * (X@X.t()).double())
+	keep = evals > eps * evals.max()
+	return (V[:, keep] / evals[keep].sqrt()).t().to(X.dtype), int(keep.sum())
+
+def select_snapshots(
+		data: torch.Tensor, n: int, obs: Observable = None, method: str = 'uniform', seed: int = None, delta: float = 0.1, 
+		bound: bool = True, n_sketch: int = None, sketch_dim: int = 16,
+	):
+	"""Select a weighted subset of snapshot pairs for fitting (see `solve_snapshots`)
+
+	Args:
+		data: simulation data (see `prep_snapshots`)
+		n: number of snapshot pairs to keep
+		obs: (optional) Observable function. If not provided, identity.
+		method: (optional) one of
+			'uniform': evenly spaced thinning. Only the selected pairs are lifted, O(n).
+			'leverage': sampling proportional to (approximate) statistical leverage of lifted snapshots. Lifts all snapshots once, O(N k sketch_dim).
+			'greedy': farthest-point coreset on lifted snapshots, weighted by cluster size, O(N n k)
+		seed: (optional) seed for sampling
+		delta: (optional) failure probability of the 'uniform'/'leverage' bound
+		bound: (optional) if False, skip the 'uniform'/'leverage' error bound (returned as None)
+		n_sketch: (optional) number of uniformly subsampled snapshots used to estimate the gramian for leverage scores and the bound. Default max(n, 10 k), capped at N.
+		sketch_dim: (optional) leverage scores are estimated through a Johnson-Lindenstrauss projection to this many dimensions (if below the rank).
+			Sampling tolerates the resulting constant-factor error in the scores.
+
+	Returns:
+		X, Y: selected (reweighted) snapshot matrices k x n
+		bound: for 'uniform'/'leverage', eps such that with probability 1-delta the fitted residual is within (1+eps)/(1-eps)
+			of the full-data residual (matrix Chernoff bound; vacuous if eps >= 1). Leverage scores, and thus the bound, are estimated from 
+			the `n_sketch` subsample rather than computed over all N snapshots. For 'greedy', the covering radius in observable space.
+	"""
+	N = _n_pairs(data, obs)
+	assert 0 < n <= N, 'Number of snapshots must be in [1, N]'
+	gen = torch.Generator()
+	gen.manual_seed(torch.randint(2**31, (1,)).item() if seed is None else seed)
+
+	def sketch(k):
+		"""Leverage map estimated from a uniform subsample"""
+		s = min(N, max(n, 10*k) if n_sketch is None else n_sketch)
+		X_s, _ = _lift_pairs_at(data, torch.randperm(N, generator=gen)[:s] if s > N // 8 else torch.randint(N, (s,), generator=gen), obs)
+		M, rank = _leverage_map(X_s, N)
+		return X_s, M, max(rank, 1)
+
+	def chernoff(coherence, rank):
+		return np.sqrt(4 * coherence * rank * np.log(2 * rank / delta) / n)
+
+	if method == 'uniform':
+		idx = torch.linspace(0, N-1, n).round().long()
+		X, Y = _lift_pairs_at(data, idx, obs)
+		w = np.sqrt(N / n)
+		eps = None
+		if bound:
+			X_s, M, rank = sketch(X.shape[0])
+			coherence = N * ((M@X_s)**2).sum(dim=0).max().item() / rank
+			eps = chernoff(coherence, rank)
+		return X * w, Y * w, eps
+	elif method == 'leverage':
+		X, Y = prep_snapshots(data, obs=obs)
+		_, M, rank = sketch(X.shape[0])
+		if sketch_dim < M.shape[0]:
+			M = (torch.randn((sketch_dim, M.shape[0]), generator=gen, dtype=M.dtype) / np.sqrt(sketch_dim))@M
+		lev = torch.ones(M.shape[0], dtype=X.dtype)@(M@X).square_()
+		prob = lev / lev.sum()
+		idx = torch.multinomial(prob, n, replacement=True, generator=gen)
+		w = 1 / torch.sqrt(n * prob[idx])
+		return X[:, idx] * w, Y[:, idx] * w, chernoff(1., rank) if bound else None
+	elif method == 'greedy':
+		X, Y = prep_snapshots(data, obs=obs)
+		idx = [0]
+		dist = torch.norm(X - X[:, :1], dim=0)
+		nearest = torch.zeros(N, dtype=torch.long)
+		for j in range(1, n):
+			i = torch.argmax(dist).item()
+			idx.append(i)
+			d_i = torch.norm(X - X[:, i:i+1], dim=0)
+			nearest[d_i < dist] = j
+			dist = torch.min(dist, d_i)
+		idx = torch.LongTensor(idx)
+		w = torch.sqrt(torch.bincount(nearest, minlength=n).to(X.dtype))
+		return X[:, idx] * w, Y[:, idx] * w, dist.max().item()
+	raise ValueError(f'Unknown selection method {method}')
+
+def solve_reduced(data: torch.Tensor, r: int, obs: Observable = None, n_oversample: int = 10, n_iter: int = 2):
+	"""Rank-r (exact) DMD via randomized SVD of the snapshot matrix
+
+	Args:
+		data: simulation data (see `prep_snapshots`)
+		r: rank of reduced operator
+		obs: (optional) Observable function. If not provided, identity.
+		n_oversample: (optional) oversampling of the randomized range finder
+		n_iter: (optional) number of subspace (power) iterations
+
+	Returns:
+		A: reduced Koopman operator (r x r), acting on projected observables U^T z
+		Phi: DMD modes (k x r, complex)
+		U: projection basis (k x r), K ~ U A U^T
+
+	Note: use `ProjectedObservable(obs, U)` to extrapolate or filter in r dimensions.
+	Fit cost is O(N k r). Based on https://arxiv.org/abs/1512.07958
+	"""
+	X, Y = prep_snapshots(data, obs=obs)
+	assert r <= min(X.shape), 'Rank must not exceed snapshot matrix dimensions'
+	U, S, V = torch.svd_lowrank(X, q=min(r + n_oversample, *X.shape), niter=n_iter)
+	U, S, V = U[:, :r], S[:r], V[:, :r]
+	YVS = (Y@V) / S
+	A = U.t()@YVS
+	_, W = torch.linalg.eig(A)
+	Phi = YVS.to(W.dtype)@W
+	return A, Phi, U
+
+def solve_generator(data: torch.Tensor, obs: Observable = None, f: Callable = None, dt: float = None):
+	"""Continuous-time Koopman generator L (dz/dt = L z in observable space)
+
+	Args:
+		data: simulation data (see `prep_snapshots`)
+		obs: (optional) Observable function. If not provided, identity.
+		f: (optional) vectorized system vector field : d (state dimension) x N -> d x N. If provided, uses generator EDMD with analytic observable derivatives.
+		dt: (optional) sampling interval of `data`. If `f` is not provided, the generator is recovered as the matrix logarithm of the discrete Koopman operator.
+
+	Returns:
+		L: Koopman generator
+
+	Note: the generator is independent of the data sampling rate; use `generator_to_koopman` to discretize at any dt.
+	Based on https://arxiv.org/abs/1909.10638
+	"""
+	if f is None:
+		assert dt is not None, 'Sampling interval required for matrix-log generator'
+		K = solve(data, obs=obs)
+		L, err = linalg.logm(K.cpu().double().numpy(), disp=False)
+		if np.abs(np.imag(L)).max() > 1e-6 * np.abs(L).max() or err > 1e-6:
+			raise ValueError(f'Koopman operator has no accurate real logarithm (error estimate {err:.1e}; negative real eigenvalues?); sample faster or provide `f`')
+		return torch.from_numpy(np.real(L) / dt).to(device=K.device, dtype=K.dtype)
+
+	if obs is None:
+		obs = Observable(data.shape[-2], data.shape[-2], 1)
+	trajectories = torch.unbind(data) if len(data.shape) == 3 else (data,)
+	Z, dZ = [], []
+	for X in trajectories:
+		Z.append(obs(X))
+		dZ.append(obs.derivative(X, f(X)))
+	Z, dZ = torch.cat(Z, 1), torch.cat(dZ, 1)
+	return dZ@Z.t()@torch.pinverse(Z@Z.t())
+
+def generator_to_koopman(L: torch.Tensor, dt: float):
+	"""Discretize Koopman generator at time step dt (K = exp(L dt))"""
+	return torch.from_numpy(linalg.expm(L.cpu().double().numpy() * dt)).to(device=L.device, dtype=L.dtype)
+
+def solve_kernel(
+		data: torch.Tensor, kernel: Kernel, koopman: bool = True, sparse_tol: float = None, 
+		reg: float = 1e-4, rtol: float = 1e-6, maxiter: int = None,
+	):
 	"""Pseudoinverse solution for Koopman & Perron-Frobenius operators over RKHS
 	
 	Args:
 		data: simulation data (see `prep_snapshots`)
 		kernel: positive-definite kernel.
 		koopman: if True, Koopman operator, else Perron-Frobenius operator.
+		sparse_tol: (optional) for `RadialKernel`s, drop kernel values below this and use sparse gramians + conjugate gradients.
+		reg: (optional) Tikhonov regularization of G_XX in the sparse path, relative to its mean diagonal. 
+			Truncated gramians are ill-conditioned (possibly indefinite); too small a value stalls conjugate gradients.
+		rtol: (optional) relative residual tolerance of conjugate gradients in the sparse path
+		maxiter: (optional) maximum conjugate gradient iterations per application in the sparse path (default 10 N)
 
 	Returns:
-		L: Koopman or Perron-Frobenius operator.
+		L: Koopman or Perron-Frobenius operator. If `sparse_tol` is provided, an N x N `scipy.sparse.linalg.LinearOperator`.
 
 	Based on https://arxiv.org/pdf/1712.01572
 	"""
 	X, Y = prep_snapshots(data)
+	if sparse_tol is not None:
+		G_XX = kernel.gramian_sparse(X, X, tol=sparse_tol)
+		G_XX = G_XX + reg * G_XX.diagonal().mean() * sparse.identity(X.shape[1], format='csr')
+		G_YX = kernel.gramian_sparse(Y, X, tol=sparse_tol)
+		G_out = G_YX if koopman else G_YX.T.tocsr()
+
+		def matvec(v):
+			w, info = sparse_linalg.cg(G_XX, np.ravel(v), rtol=rtol, maxiter=maxiter)
+			if info != 0:
+				raise RuntimeError(f'Conjugate gradients did not converge (info={info}); increase `reg` or `maxiter`')
+			return G_out@w
+		return sparse_linalg.LinearOperator(G_out.shape, matvec=matvec, dtype=np.float64)
 	G_XX = kernel.gramian(X, X)
 	G_YX = kernel.gramian(Y, X)
 	if koopman:
@@ -144,6 +421,54 @@ def solve_kernel(data: torch.Tensor, kernel: Kernel, koopman: bool = True):
 	else:
 		return G_YX.t()@torch.pinverse(G_XX)
 
+def _landmarks(X: torch.Tensor, kernel: Kernel, m: int, sampling: str, gen: torch.Generator, n_iter: int = 10, reg: float = 1e-6):
+	N = X.shape[1]
+	idx = torch.randperm(N, generator=gen)[:m]
+	if sampling == 'uniform':
+		return X[:, idx]
+	elif sampling == 'kmeans':
+		C = X[:, idx].t().clone()
+		for _ in range(n_iter): # Lloyd iterations
+			assign = torch.cdist(X.t(), C).argmin(dim=1)
+			counts = torch.bincount(assign, minlength=m).to(X.dtype)
+			sums = torch.zeros_like(C).index_add_(0, assign, X.t())
+			nonempty = counts > 0
+			C[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1)
+		return C.t()
+	elif sampling == 'leverage':
+		# Ridge leverage scores under a preliminary uniform Nystrom sample
+		Z = NystromObservable(kernel, X[:, idx])(X)
+		G = Z@Z.t()
+		scores = (Z * torch.linalg.solve(G + reg * G.trace() * torch.eye(G.shape[0], dtype=G.dtype), Z)).sum(dim=0).clamp(min=0)
+		return X[:, torch.multinomial(scores + 1e-12, m, replacement=False, generator=gen)]
+	raise ValueError(f'Unknown landmark sampling {sampling}')
+
+def solve_kernel_nystrom(data: torch.Tensor, kernel: Kernel, m: int, koopman: bool = True, sampling: str = 'uniform', seed: int = None):
+	"""Nystrom-approximated kernel DMD
+	
+	Args:
+		data: simulation data (see `prep_snapshots`)
+		kernel: positive-definite kernel.
+		m: number of landmark snapshots
+		koopman: (optional) if True, Koopman operator, else Perron-Frobenius operator.
+		sampling: (optional) landmark selection, 'uniform', 'kmeans' or 'leverage' (ridge leverage scores)
+		seed: (optional) seed for landmark selection
+
+	Returns:
+		L: Koopman or Perron-Frobenius operator (m x m) over Nystrom features
+		obs: Nystrom observable, usable with `predict`/`extrapolate`
+
+	Cost is O(N m^2) time and O(N m) memory. With all N snapshots as landmarks, the operator is similar to that of
+	`solve_kernel` (koopman=False), so their spectra coincide.
+	"""
+	X, _ = prep_snapshots(data)
+	assert m <= X.shape[1], 'Number of landmarks must not exceed number of snapshots'
+	gen = torch.Generator()
+	gen.manual_seed(torch.randint(2**31, (1,)).item() if seed is None else seed)
+	obs = NystromObservable(kernel, _landmarks(X, kernel, m, sampling, gen))
+	obs.fit_preimage(X)
+	return solve(data, koopman=koopman, obs=obs), obs
+
 def solve_with_control(batch_data: torch.Tensor, batch_inputs: torch.Tensor, obs: Observable = None):
 	"""Pseudoinverse solution for Koopman operator w/ control influence matrix.
 
@@ -173,3 +498,426 @@ def solve_with_control(batch_data: torch.Tensor, batch_inputs: torch.Tensor, obs
 
 
 
+""" Out-of-core estimation """
+
+class Gramians:
+	"""Accumulated snapshot gramians G = X X^T and A = Y X^T (float64), sufficient statistics for DMD/EDMD.
+
+	Partial gramians over disjoint snapshot sets can be summed with `+`.
+	"""
+	def __init__(self):
+		self.G, self.A, self.n = None, None, 0
+
+	def add(self, X: torch.Tensor, Y: torch.Tensor):
+		X, Y = X.to(torch.float64), Y.to(torch.float64)
+		G, A = X@X.t(), Y@X.t()
+		if self.G is None:
+			self.G, self.A = G, A
+		else:
+			self.G += G
+			self.A += A
+		self.n += X.shape[1]
+		return self
+
+	def __add__(self, other):
+		return Gramians().add_gramians(self).add_gramians(other)
+
+	def add_gramians(self, other):
+		if other.G is not None:
+			if self.G is None:
+				self.G, self.A = other.G.clone(), other.A.clone()
+			else:
+				self.G += other.G
+				self.A += other.A
+			self.n += other.n
+		return self
+
+	def solve(self, koopman: bool = True, dtype=torch.float32):
+		"""Pseudoinverse solution from gramians (see `solve`)"""
+		assert self.G is not None, 'No snapshots accumulated'
+		if koopman:
+			return (self.A@torch.pinverse(self.G)).to(dtype)
+		else:
+			return (self.A.t()@torch.pinverse(self.G)).to(dtype)
+
+def _time_chunks(data, chunk: int):
+	"""Iterate over time chunks of a d x N tensor, array or memmap, or pass through an iterable of d x n_i chunks"""
+	if isinstance(data, (torch.Tensor, np.ndarray)):
+		for s in range(0, data.shape[1], chunk):
+			yield torch.as_tensor(np.ascontiguousarray(data[:, s:s+chunk])) if isinstance(data, np.ndarray) else data[:, s:s+chunk]
+	else:
+		for C in data:
+			yield torch.as_tensor(C)
+
+def _lifted_pairs(chunks, obs: Observable = None, input_chunks=None):
+	"""Lift consecutive chunks of one trajectory into snapshot pairs, carrying observable memory across chunk boundaries
+
+	Yields:
+		X, Y (and U if `input_chunks` is provided) for pairs ending in each chunk; each pair appears exactly once.
+	"""
+	m = 1 if obs is None else obs.m
+	input_chunks = iter(()) if input_chunks is None else input_chunks
+	prev, prev_u = None, None
+	for W in chunks:
+		W_u = next(input_chunks, None)
+		if prev is not None:
+			W = torch.cat((prev, W), 1)
+			if W_u is not None:
+				W_u = torch.cat((prev_u, W_u), 1)
+		if W.shape[1] < m + 1: # not enough memory for a pair yet
+			prev, prev_u = W, W_u
+			continue
+		Z = W if obs is None else obs(W)
+		if W_u is None:
+			yield Z[:, :-1], Z[:, 1:]
+		else:
+			yield Z[:, :-1], Z[:, 1:], W_u[:, m-1:-1]
+		prev = W[:, -m:]
+		prev_u = None if W_u is None else W_u[:, -m:]
+
+def solve_chunked(data, koopman: bool = True, obs: Observable = None, chunk: int = 10000):
+	"""Out-of-core pseudoinverse solution for Koopman & Perron-Frobenius operators.
+
+	Args:
+		data: simulation data, any of
+			(a) d (state dimension) x N (trajectory length) tensor, array or `np.memmap`
+			(b) b (# simulations) x d x N tensor, array or `np.memmap`
+			(c) iterable of consecutive d x n_i chunks of a single trajectory
+		koopman: (optional) if True, Koopman operator, else Perron-Frobenius operator.
+		obs: (optional) Observable function. If not provided, identity.
+		chunk: (optional) number of snapshots read and lifted at a time
+
+	Returns:
+		L: Koopman or Perron-Frobenius operator (same as `solve`).
+
+	Only the k x k gramians are kept, so memory is O(k^2 + chunk * k) regardless of N.
+	"""
+	gram = Gramians()
+	trajectories = data if isinstance(data, (torch.Tensor, np.ndarray)) and len(data.shape) == 3 else (data,)
+	for traj in trajectories:
+		for X, Y in _lifted_pairs(_time_chunks(traj, chunk), obs=obs):
+			gram.add(X, Y)
+	return gram.solve(koopman=koopman)
+
+def solve_with_control_chunked(batch_data, batch_inputs, obs: Observable = None, chunk: int = 10000):
+	"""Out-of-core pseudoinverse solution for Koopman operator w/ control influence matrix.
+
+	Args:
+		batch_data: trajectory data b (# simulations) x d (observable dimension) x N (trajectory length); tensor, array or `np.memmap`
+		batch_inputs: control inputs b (# simulations) x d_u (control input dimension) x N (trajectory length); tensor, array or `np.memmap`
+		obs: (optional) Observable function.
+		chunk: (optional) number of snapshots read and lifted at a time
+
+	Returns:
+		K: Koopman operator for uncontrolled system
+		B: Control influence matrix in observable space
+
+	See `solve_with_control`; memory is O((k + d_u)^2 + chunk * k).
+	"""
+	assert batch_data.shape[0] == batch_inputs.shape[0] and batch_data.shape[2] == batch_inputs.shape[2], "Trajectory and control input dimensions must match"
+	gram = Gramians()
+	for traj, inputs in zip(batch_data, batch_inputs):
+		for X, Y, U in _lifted_pairs(_time_chunks(traj, chunk), obs=obs, input_chunks=_time_chunks(inputs, chunk)):
+			gram.add(torch.cat((X, U.to(X.dtype)), 0), Y)
+	d = gram.A.shape[0]
+	L = gram.solve()
+	return L[:, :d], L[:, d:]
+
+""" Parallel estimation """
+
+# Multiprocessing cannot pickle lambdas; trajectory generator is inherited by forked workers
+_shard_system = None
+
+def _shard_worker(shard: List, obs: Observable, chunk: int):
+	torch.set_num_threads(1) # avoid oversubscription across workers
+	gram = Gramians()
+	for ic, u in shard:
+		traj = _shard_system(ic, u)
+		for X, Y, U in _lifted_pairs(_time_chunks(traj, chunk), obs=obs, input_chunks=_time_chunks(u, chunk)):
+			gram.add(torch.cat((X, U.to(X.dtype)), 0), Y)
+	return gram
+
+def solve_with_control_parallel(system: Callable, ics: List, inputs: List, obs: Observable = None, n_workers: int = None, chunk: int = 10000):
+	"""Sharded, multi-process version of `gen_control_data` + `solve_with_control`.
+
+	Args:
+		system: trajectory generator : (initial condition, input) -> trajectory
+		ics: list of initial conditions
+		inputs: list of control inputs (d_u x N)
+		obs: (optional) Observable function.
+		n_workers: (optional) number of worker processes. Defaults to CPU count.
+		chunk: (optional) number of snapshots lifted at a time within a worker
+
+	Returns:
+		K: Koopman operator for uncontrolled system
+		B: Control influence matrix in observable space
+
+	Each worker simulates and lifts a shard of (initial condition, input) pairs and returns only its partial gramians,
+	which are summed and solved in the parent. Requires the 'fork' start method.
+	"""
+	global _shard_system
+	_shard_system = system
+
+	tasks = [(ic, u) for u in inputs for ic in ics]
+	n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+	shards = [tasks[i::n_workers] for i in range(n_workers) if len(tasks[i::n_workers]) > 0]
+	with multiprocessing.get_context('fork').Pool(len(shards)) as pool:
+		grams = pool.starmap(_shard_worker, [(shard, obs, chunk) for shard in shards])
+
+	gram = sum(grams, Gramians())
+	d = gram.A.shape[0]
+	L = gram.solve()
+	return L[:, :d], L[:, d:]
+
+""" Online estimation """
+
+class OnlineKoopman:
+	"""Recursive (online) DMD: rank-1 least-squares updates of the Koopman operator, O(k^2) per snapshot pair.
+
+	Args:
+		k: observable dimension
+		d_u: (optional) control input dimension. If nonzero, estimates [K B] (see `solve_with_control`).
+		lam: (optional) exponential forgetting factor in (0, 1]
+		window: (optional) if provided, exact sliding window over this many snapshot pairs (uses rank-1 downdates). Requires lam = 1.
+		delta: (optional) regularization of the initial inverse gramian, P = I / delta
+		obs: (optional) Observable applied to incoming states. Must be memoryless (m = 1). If not provided, snapshots are used as given.
+
+	Based on https://arxiv.org/abs/1707.02876
+	"""
+	def __init__(self, k: int, d_u: int = 0, lam: float = 1., window: int = None, delta: float = 1e-6, obs: Observable = None):
+		assert 0 < lam <= 1, 'Forgetting factor must be in (0, 1]'
+		assert window is None or lam == 1, 'Sliding window requires lam = 1'
+		assert obs is None or obs.m == 1, 'Observable must be memoryless'
+		self.k = k
+		self.d_u = d_u
+		self.lam = lam
+		self.window = window
+		self.obs = obs
+		self.L = torch.zeros((k, k + d_u), dtype=torch.float64)
+		self.P = torch.eye(k + d_u, dtype=torch.float64) / delta
+		self.pairs = deque() # snapshot pairs in window
+
+	@property
+	def K(self):
+		return self.L[:, :self.k]
+
+	@property
+	def B(self):
+		return self.L[:, self.k:]
+
+	def _prep(self, X: torch.Tensor, Y: torch.Tensor, U: torch.Tensor = None):
+		if len(X.shape) == 1:
+			X, Y = X.unsqueeze(1), Y.unsqueeze(1)
+			if U is not None:
+				U = U.unsqueeze(1)
+		if self.obs is not None:
+			X, Y = self.obs(X), self.obs(Y)
+		assert X.shape[0] == self.k, 'Snapshot dimension must match observable dimension'
+		assert (U is None) == (self.d_u == 0), 'Control inputs required iff d_u > 0'
+		if U is not None:
+			X = torch.cat((X, U), 0)
+		return X.to(torch.float64), Y.to(torch.float64)
+
+	def init(self, X: torch.Tensor, Y: torch.Tensor, U: torch.Tensor = None):
+		"""Initialize from a batch of snapshot pairs by pseudoinverse (X, Y: d x N, U: d_u x N)"""
+		Xu, Y = self._prep(X, Y, U)
+		self.P = torch.pinverse(Xu@Xu.t())
+		self.L = Y@Xu.t()@self.P
+		if self.window is not None:
+			self.pairs = deque(zip(Xu.t()[-self.window:], Y.t()[-self.window:]))
+			if Xu.shape[1] > self.window: # refit on retained window
+				Xw, Yw = torch.stack([x for x, _ in self.pairs], 1), torch.stack([y for _, y in self.pairs], 1)
+				self.P = torch.pinverse(Xw@Xw.t())
+				self.L = Yw@Xw.t()@self.P
+
+	def _rank1(self, xu: torch.Tensor, y: torch.Tensor, sign: float):
+		Px = self.P@xu
+		self.P = (self.P - sign * torch.outer(Px, Px) / (self.lam + sign * (xu@Px))) / self.lam
+		self.P = (self.P + self.P.t()) / 2
+		self.L = self.L + sign * torch.outer(y - self.L@xu, self.P@xu)
+
+	def update(self, X: torch.Tensor, Y: torch.Tensor, U: torch.Tensor = None):
+		"""Incorporate snapshot pair(s)
+
+		Args:
+			X: current snapshot(s), d or d x b
+			Y: next snapshot(s), d or d x b
+			U: (optional) control input(s), d_u or d_u x b
+
+		Returns:
+			L: current estimate, K (k x k) or [K B] (k x (k + d_u))
+		"""
+		Xu, Y = self._prep(X, Y, U)
+		for xu, y in zip(Xu.t(), Y.t()):
+			self._rank1(xu, y, 1.)
+			if self.window is not None:
+				self.pairs.append((xu, y))
+				if len(self.pairs) > self.window:
+					self._rank1(*self.pairs.popleft(), -1.)
+		return self.L
+
+""" Tests """
+
+if __name__ == '__main__':
+	from totorch.utils import set_seed
+	set_seed(9001)
+
+	print('Modal Koopman test')
+	# Real operator with two complex-conjugate pairs, one real mode and one null mode
+	blocks = [np.array([[.9, -.3], [.3, .9]]), np.array([[.5, -.5], [.5, .5]]), np.array([[.3]]), np.array([[0.]])]
+	L = linalg.block_diag(*blocks)
+	P = np.random.randn(6, 6)
+	K = P@L@np.linalg.inv(P)
+	for r in range(1, 7):
+		modal = ModalKoopman(K, r)
+		assert modal.r in (r, r+1), 'modal truncation rank incorrect'
+		K_r = modal.V@np.diag(modal.lam)@modal.W
+		assert np.abs(K_r.imag).max() < 1e-8, f'modal truncation r={r} splits a conjugate pair'
+	assert ModalKoopman(K, 2).r == 2 and ModalKoopman(K, 1).r == 2 and ModalKoopman(K, 3).r == 4, 'conjugate pair bookkeeping incorrect'
+	modal = ModalKoopman(K, 5) # drops only the null mode
+	assert np.allclose(np.real(modal.V@np.diag(modal.lam)@modal.W), K), 'modal reconstruction incorrect'
+	z = np.random.randn(6, 4)
+	assert np.allclose(modal.from_modal(modal.propagate(modal.to_modal(z))), K@z), 'modal propagation incorrect'
+
+	def rel_err(A, B):
+		A, B = torch.as_tensor(A), torch.as_tensor(B)
+		A, B = (A.to(torch.complex128), B.to(torch.complex128)) if A.is_complex() or B.is_complex() else (A.double(), B.double())
+		return (torch.norm(A - B) / torch.norm(B)).item()
+
+	# Nonlinear map with control, lifted by polynomials
+	def simulate(ic, u, N=400):
+		x = torch.zeros((2, N), dtype=torch.float64)
+		x[:, 0] = torch.as_tensor(ic)
+		for t in range(N-1):
+			x[0, t+1] = 0.9*x[0, t] + 0.1*x[1, t]
+			x[1, t+1] = 0.8*x[1, t] - 0.2*x[0, t]**2 + 0.1*u[0, t] + 0.01*np.sin(t)
+		return x
+	obs = PolynomialObservable(3, 2, 8)
+	ics = [np.random.uniform(-1, 1, 2) for _ in range(3)]
+	inputs = [0.5*torch.randn((1, 400), dtype=torch.float64) for _ in range(2)]
+	batch_data, batch_inputs = gen_control_data(simulate, ics, inputs)
+	data = batch_data[0]
+	K_ref = solve(data, obs=obs)
+	K_u, B_u = solve_with_control(batch_data, batch_inputs, obs=obs)
+
+	print('Out-of-core test')
+	assert rel_err(solve_chunked(data, obs=obs, chunk=37), K_ref) < 1e-6, 'chunked solution incorrect'
+	assert rel_err(solve_chunked(data.numpy(), obs=obs, chunk=37), K_ref) < 1e-6, 'chunked solution (numpy) incorrect'
+	assert rel_err(solve_chunked(batch_data, obs=obs, chunk=50), solve(batch_data, obs=obs)) < 1e-6, 'chunked batch solution incorrect'
+	assert rel_err(solve_chunked(data, koopman=False, obs=obs, chunk=64), solve(data, koopman=False, obs=obs)) < 1e-6, 'chunked Perron-Frobenius solution incorrect'
+	delay = DelayObservable(2, 3)
+	assert rel_err(solve_chunked(iter(torch.split(data, 25, 1)), obs=delay), solve(data, obs=delay)) < 1e-6, 'chunked delay solution incorrect'
+	K_c, B_c = solve_with_control_chunked(batch_data, batch_inputs, obs=obs, chunk=41)
+	assert rel_err(K_c, K_u) < 1e-6 and rel_err(B_c, B_u) < 1e-6, 'chunked control solution incorrect'
+
+	print('Parallel test')
+	K_p, B_p = solve_with_control_parallel(simulate, ics, inputs, obs=obs, n_workers=2, chunk=100)
+	assert rel_err(K_p, K_u) < 1e-6 and rel_err(B_p, B_u) < 1e-6, 'parallel control solution incorrect'
+
+	print('Online test')
+	Z = obs(data)
+	online = OnlineKoopman(obs.k)
+	online.init(Z[:, :100], Z[:, 1:101])
+	online.update(Z[:, 100:-1], Z[:, 101:])
+	assert rel_err(online.K, K_ref) < 1e-6, 'online solution incorrect'
+	online = OnlineKoopman(obs.k, window=150)
+	online.init(Z[:, :200], Z[:, 1:201])
+	for t in range(200, Z.shape[1]-1):
+		online.update(Z[:, t], Z[:, t+1])
+	assert rel_err(online.K, solve(data[:, -151:], obs=obs)) < 1e-4, 'sliding-window online solution incorrect'
+	online = OnlineKoopman(obs.k, d_u=1, obs=obs)
+	online.init(batch_data[0, :, :50], batch_data[0, :, 1:51], batch_inputs[0, :, :50])
+	online.update(batch_data[0, :, 50:-1], batch_data[0, :, 51:], batch_inputs[0, :, 50:-1])
+	K_1, B_1 = solve_with_control(batch_data[:1], batch_inputs[:1], obs=obs)
+	assert rel_err(online.K, K_1) < 1e-6 and rel_err(online.B, B_1) < 1e-6, 'online control solution incorrect'
+
+	print('Reduced DMD test')
+	A, Phi, U = solve_reduced(data, obs.k, obs=obs)
+	assert rel_err(U@A@U.t(), K_ref) < 1e-6, 'full-rank reduced solution incorrect'
+	lam = torch.linalg.eigvals(A)
+	assert rel_err(K_ref.to(Phi.dtype)@Phi, Phi*lam) < 1e-6, 'DMD modes incorrect'
+
+	# Linear system: any full-rank subset of snapshots recovers the exact operator
+	A_c = torch.tensor([[-0.1, 1.], [-1., -0.1]], dtype=torch.float64)
+	dt = 0.05
+	A_d = generator_to_koopman(A_c, dt)
+	lin = torch.zeros((2, 300), dtype=torch.float64)
+	lin[:, 0] = torch.tensor([1., 0.5])
+	for t in range(299):
+		lin[:, t+1] = A_d@lin[:, t]
+
+	print('Generator test')
+	assert rel_err(solve_generator(lin, f=lambda X: A_c@X), A_c) < 1e-8, 'gEDMD generator incorrect'
+	assert rel_err(solve_generator(lin, dt=dt), A_c) < 1e-6, 'matrix-log generator incorrect'
+	L = solve_generator(data, obs=obs, dt=1.)
+	assert rel_err(generator_to_koopman(L, 1.), K_ref) < 1e-6, 'generator discretization incorrect'
+	flip = torch.zeros((2, 50), dtype=torch.float64)
+	flip[:, 0] = torch.Tensor([1., 1.])
+	for t in range(49):
+		flip[:, t+1] = torch.Tensor([-0.9, 0.8]).double() * flip[:, t]
+	try:
+		solve_generator(flip, dt=1.)
+		assert False, 'matrix-log generator of a negative real eigenvalue not reported'
+	except ValueError:
+		pass
+
+	print('Snapshot selection test')
+	for method in ('uniform', 'leverage', 'greedy'):
+		X_s, Y_s, bound = select_snapshots(lin, 20, method=method, seed=0)
+		assert X_s.shape == (2, 20), f'{method} selection shape incorrect'
+		assert rel_err(solve_snapshots(X_s, Y_s), A_d) < 1e-8, f'{method} selection solution incorrect'
+	for obs_s, data_s in ((obs, data), (delay, data), (obs, batch_data), (delay, batch_data)):
+		X_s, Y_s, _ = select_snapshots(data_s, _n_pairs(data_s, obs_s), obs=obs_s, method='uniform', bound=False)
+		assert rel_err(solve_snapshots(X_s, Y_s), solve(data_s, obs=obs_s)) < 1e-6, 'uniform selection of all snapshots incorrect'
+	_, _, eps = select_snapshots(data, 100, obs=obs, method='uniform', seed=0)
+	_, _, eps_lev = select_snapshots(data, 100, obs=obs, method='leverage', seed=0)
+	assert 0 < eps_lev <= eps, 'selection bounds incorrect'
+
+	print('Nystrom kernel DMD test')
+	# Spread-out spiral trajectory; ill-conditioned gramians (clustered snapshots) make both spectra numerically meaningless
+	X_k = torch.zeros((2, 30), dtype=torch.float64)
+	X_k[:, 0] = torch.tensor([1., 0.5])
+	for t in range(29):
+		X_k[0, t+1] = 0.9*X_k[0, t] + 0.3*X_k[1, t]
+		X_k[1, t+1] = -0.3*X_k[0, t] + 0.9*X_k[1, t] - 0.1*X_k[0, t]**2
+	kernel = GaussianKernel(0.3)
+	L_full = solve_kernel(X_k, kernel, koopman=False)
+	L_nys, nys_obs = solve_kernel_nystrom(X_k, kernel, X_k.shape[1]-1, koopman=False, seed=0)
+	ev_full = torch.linalg.eigvals(L_full).abs().sort(descending=True).values[:5]
+	ev_nys = torch.linalg.eigvals(L_nys).abs().sort(descending=True).values[:5]
+	assert rel_err(ev_nys, ev_full) < 1e-3, 'Nystrom spectrum does not match kernel DMD'
+
+	print('Sparse kernel DMD test')
+	kernel = GaussianKernel(0.5)
+	for koopman in (True, False):
+		L_sp = solve_kernel(X_k, kernel, koopman=koopman, sparse_tol=1e-6)
+		G_XX = kernel.gramian_sparse(X_k[:, :-1], X_k[:, :-1], tol=1e-6).toarray()
+		G_YX = kernel.gramian_sparse(X_k[:, 1:], X_k[:, :-1], tol=1e-6).toarray()
+		G_out = G_YX if koopman else G_YX.T
+		v = np.random.randn(G_XX.shape[0])
+		ref = G_out@np.linalg.solve(G_XX + 1e-4 * G_XX.diagonal().mean() * np.eye(G_XX.shape[0]), v)
+		assert rel_err(L_sp@v, ref) < 1e-4, 'sparse kernel operator does not match dense regularized solve'
+	try:
+		solve_kernel(X_k, kernel, sparse_tol=1e-6, reg=0., maxiter=1)@v
+		assert False, 'unconverged conjugate gradients not reported'
+	except RuntimeError:
+		pass
+
+	print('Koopman wrapper test')
+	obs = PolynomialObservable(3, 2, 8)
+	K32 = np.random.randn(obs.k, obs.k).astype(np.float32) / obs.k
+	koop = Koopman(K32, obs)
+	x = obs.call_numpy(np.random.randn(2, 3))
+	out = np.empty_like(x)
+	assert koop.apply(x, out=out) is out and np.allclose(out, koop@x), 'in-place apply does not match matmul'
+	offset = 1e-3 * np.random.randn(obs.k, obs.k)
+	koop.set_offset(offset)
+	assert koop.K.dtype == np.float64 and np.array_equal(koop.K, K32 + offset), 'offset not promoted like K + offset'
+	assert koop.K_torch.dtype == torch.float32 and np.allclose(koop.K_torch.numpy(), K32 + offset, atol=1e-6), 'torch operator ignores offset'
+	assert np.allclose(koop.apply(x, out=out), obs.call_numpy(((K32 + offset)@x)[:2])), 'in-place apply ignores offset'
+	koop.zero_offset()
+	assert np.array_equal(koop.K, K32 + koop.offset0) and np.array_equal(koop.T.K, koop.K), 'offset not reset'
+	rff = GaussianObservable(2, 10, 1., seed=0)
+	K_rff = np.random.randn(rff.k, rff.k) / rff.k
+	x = rff.call_numpy(np.random.randn(2, 3))
+	assert np.allclose(Koopman(K_rff, rff).apply(x, out=np.empty_like(x)), Koopman(K_rff, rff)@x), 'in-place apply incorrect for random Fourier features'
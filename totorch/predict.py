@@ -1,14 +1,15 @@
 """ Prediction & extrapolation """
 
 import torch
+import torch.utils.checkpoint
 import numpy as np
 import itertools
-import traceback
-from tqdm import tqdm
-import multiprocessing
 import pdb
 
 from totorch.features import *
+from totorch.utils import TensorCache
+
+_spectra = TensorCache()
 
 def predict(X: torch.Tensor, K: torch.Tensor, obs: Observable):
 	"""Perform one-step prediction from snapshot matrix.
@@ -20,25 +21,108 @@ def predict(X: torch.Tensor, K: torch.Tensor, obs: Observable):
 	"""
 	return obs.preimage(K@obs(X))
 
+def spectrum(K: torch.Tensor):
+	"""Eigendecomposition K = V diag(evals) V^-1 (complex128), cached per operator until K is modified in place.
+
+	Returns:
+		evals, V, V_inv
+	"""
+	def decompose():
+		evals, V = torch.linalg.eig(K.detach().double())
+		return evals, V, torch.linalg.inv(V)
+	return _spectra.get((K,), decompose)
+
+def _lift_batch(obs: Observable, X: torch.Tensor):
+	"""Lift a batch of observation windows d x m x b to k x b"""
+	if obs.m == 1:
+		return obs(X[:, 0])
+	d, m, b = X.shape
+	Z = obs(X.permute(0, 2, 1).reshape(d, b*m)) # windows laid end to end
+	return Z[:, ::m]
+
+def _unlift_batch(obs: Observable, Z: torch.Tensor):
+	"""Preimage of a batch of lifted trajectories k x t x b"""
+	k, t, b = Z.shape
+	X = obs.preimage(Z.reshape(k, t*b))
+	return X.reshape(X.shape[0], t, b)
+
+def _control(B: torch.Tensor, u: torch.Tensor, i: int):
+	"""Control influence B u_i as k x b (or k x 1, broadcast over batch)"""
+	Bu = B@u[:, i]
+	return Bu.unsqueeze(1) if len(Bu.shape) == 1 else Bu
+
+def _rollout(K: torch.Tensor, obs: Observable, B: torch.Tensor, unlift_every: bool, state: torch.Tensor, u: torch.Tensor, n: int):
+	"""Differentiable rollout of n steps from state (d x m x b window if `unlift_every`, else lifted k x b). Returns d x n x b or k x n x b."""
+	out = []
+	for j in range(n):
+		if unlift_every:
+			z = K@_lift_batch(obs, state)
+		else:
+			z = K@state
+		if u is not None:
+			z = z + _control(B, u, j)
+		if unlift_every:
+			x = obs.preimage(z)
+			state = torch.cat((state[:, 1:], x.unsqueeze(1)), dim=1)
+			out.append(x)
+		else:
+			state = z
+			out.append(z)
+	return torch.stack(out, dim=1)
+
+def _as_batch(X0: torch.Tensor):
+	if len(X0.shape) == 1:
+		X0 = X0.unsqueeze(1)
+	if len(X0.shape) == 2:
+		return X0.unsqueeze(2), False
+	return X0, True
+
+def extrapolate_spectral(X0: torch.Tensor, K: torch.Tensor, obs: Observable, T):
+	"""Extrapolate uncontrolled dynamics in closed form, z_t = V diag(evals^t) V^-1 z_0, for all horizons at once.
+
+	Args:
+		X0: d (state dimension) x m initial conditions, or d x m x b (batch) 
+		K: Koopman operator (diagonalizable)
+		obs: Observable function
+		T: extrapolation length (returns horizons 0..T), or 1-d tensor of horizons
+
+	Equivalent to `extrapolate(..., unlift_every=False)` without control inputs, up to eigendecomposition conditioning.
+	"""
+	X0, batched = _as_batch(X0)
+	t = torch.arange(T+1) if isinstance(T, int) else torch.as_tensor(T)
+	t = t.to(torch.float64).to(K.device)
+	evals, V, V_inv = spectrum(K)
+	w0 = V_inv@_lift_batch(obs, X0[:, :obs.m]).to(V.dtype) # modal initial conditions k x b
+	powers = torch.polar(evals.abs().unsqueeze(1)**t, evals.angle().unsqueeze(1)*t) # evals^t, k x len(t)
+	W = w0.unsqueeze(1) * powers.unsqueeze(2) # k x len(t) x b
+	Z = (V@W.reshape(W.shape[0], -1)).real.reshape(W.shape)
+	Y = _unlift_batch(obs, Z.to(X0.dtype))
+	return Y if batched else Y[:, :, 0]
+
 def extrapolate(
 		X0: torch.Tensor, K: torch.Tensor, obs: Observable, T: int, 
-		B=None, u=None, unlift_every=True,
+		B=None, u=None, unlift_every=True, spectral=False, checkpoint_every=None,
 	):
 	"""Extrapolate dynamical system from initial conditions using Koopman operator. 
 
 	Args:
-		X0: d (state dimension) x m initial conditions
+		X0: d (state dimension) x m initial conditions, or d x m x b for a batch of b initial conditions
 		K: Koopman operator
 		obs: Observable function
 		T: extrapolation length
 		B: (optional) control influence matrix 
-		u: (optional) control inputs d (input dimension) x T (trajectory length)
+		u: (optional) control inputs d (input dimension) x T (trajectory length), or d x T x b (per batch element)
  		unlift_every: (optional) use slower but more accurate extrapolation method (TODO: should not have a difference)
+		spectral: (optional) if True (and `unlift_every` is False, no control), evaluate all steps at once from the cached eigendecomposition of K (see `extrapolate_spectral`)
+		checkpoint_every: (optional) for differentiable rollouts, checkpoint segments of this many steps; 
+			intermediates are recomputed during backward so autograd memory no longer grows with every lift.
+
+	Returns:
+		d x t trajectories (d x t x b for batched initial conditions). Every step advances the whole batch with one lift and matmul.
 	"""
 	assert X0.shape[0] == obs.d, 'IC dimension should match observable parameters'
 	if len(X0.shape) == 1:
 		assert obs.m == 1, f'Insufficient initial conditions for observable with memory requirement {obs.m}'
-		X0 = X0.unsqueeze(1)
 	else:
 		assert X0.shape[1] >= obs.m, f'Insufficient initial conditions for observable with memory requirement {obs.m}'
 	if u is not None:
@@ -47,57 +131,55 @@ def extrapolate(
 
 	t = T + obs.m # Return initial conditions + extrapolation
 
-	if unlift_every:
-		if X0.requires_grad:
-			Y = [X0[:, :obs.m]]
-			x_cur = X0[:, :obs.m].unsqueeze(1)
-			for i in range(obs.m, t):
-				z = K@obs(x_cur)
-				if u is not None:
-					z = z + B@u[:, i-1]
-				x_cur = obs.preimage(z)
-				Y.append(x_cur.view(-1))
-			return torch.stack(Y, dim=1)
+	if spectral:
+		assert not unlift_every and u is None, 'Spectral extrapolation requires unlift_every=False and no control inputs'
+		return extrapolate_spectral(X0, K, obs, T)
+
+	X0, batched = _as_batch(X0)
+	d, b = obs.d, X0.shape[2]
+
+	if X0.requires_grad or (u is not None and u.requires_grad):
+		if unlift_every:
+			state = X0[:, :obs.m]
+			segments = [state]
 		else:
-			Y = torch.full((obs.d, t), np.nan, device=X0.device)
-			Y[:, :obs.m] = X0[:, :obs.m]
-			for i in range(obs.m, t):
-				x = Y[:, i-obs.m:i]
-				z = K@obs(x)
-				if u is not None:
-					z += B@u[:, i-1]
-				Y[:, i] = obs.preimage(z).view(-1)
-			return Y
+			state = _lift_batch(obs, X0[:, :obs.m])
+			segments = [state.unsqueeze(1)]
+		seg_len = max(1, t - obs.m if checkpoint_every is None else checkpoint_every)
+		for i in range(obs.m, t, seg_len):
+			n = min(seg_len, t - i)
+			u_seg = None if u is None else u[:, i-1:i-1+n]
+			if checkpoint_every is None:
+				seg = _rollout(K, obs, B, unlift_every, state, u_seg, n)
+			else:
+				seg = torch.utils.checkpoint.checkpoint(_rollout, K, obs, B, unlift_every, state, u_seg, n, use_reentrant=False)
+			segments.append(seg)
+			state = torch.cat((state, seg), dim=1)[:, -obs.m:] if unlift_every else seg[:, -1]
+		Y = torch.cat(segments, dim=1)
+		if not unlift_every:
+			Y = _unlift_batch(obs, Y)
+	elif unlift_every:
+		Y = torch.full((d, t, b), np.nan, dtype=X0.dtype, device=X0.device)
+		Y[:, :obs.m] = X0[:, :obs.m]
+		for i in range(obs.m, t):
+			z = K@_lift_batch(obs, Y[:, i-obs.m:i])
+			if u is not None:
+				z += _control(B, u, i-1)
+			Y[:, i] = obs.preimage(z)
 	else:
-		if X0.requires_grad:
-			z_cur = obs(X0[:, :obs.m])
-			Z = [z_cur.view(-1)]
-			for i in range(obs.m, t):
-				z_cur = K@z_cur
-				if u is not None:
-					z_cur = z_cur + B@u[:, i-1]
-				Z.append(z_cur.view(-1))
-			return obs.preimage(torch.stack(Z, dim=1))
-		else:
-			Z = torch.full((obs.k, t), np.nan, device=X0.device)
-			Z[:, 0] = obs(X0[:, :obs.m]).view(-1)
-			for i in range(obs.m, t):
-				j = i-obs.m
-				Z[:, j+1] = K@Z[:,j]
-				if u is not None:
-					Z[:, j+1] += B@u[:, i-1]
-			return obs.preimage(Z)
-
-def _tr_worker(ic: tuple, K: torch.Tensor, obs: Observable, T: int):
-	try:
-		ic = torch.Tensor(list(ic)).unsqueeze(0)
-		tr = extrapolate(K, obs, ic, T)
-		return tr
-	except:
-		print(traceback.format_exc())
+		Z = torch.full((obs.k, t-obs.m+1, b), np.nan, dtype=X0.dtype, device=X0.device)
+		Z[:, 0] = _lift_batch(obs, X0[:, :obs.m])
+		for i in range(obs.m, t):
+			j = i-obs.m
+			Z[:, j+1] = K@Z[:, j]
+			if u is not None:
+				Z[:, j+1] += _control(B, u, i-1)
+		Y = _unlift_batch(obs, Z)
+
+	return Y if batched else Y[:, :, 0]
 
 def extrapolate_many(K: torch.Tensor, obs: Observable, ic_space: np.ndarray, T: int):
-	"""Efficiently extrapolate trajectories from multiple initial conditions in parallel.
+	"""Extrapolate trajectories from a grid of initial conditions as a single batch.
 
 	Args:
 		K: Koopman operator
@@ -106,26 +188,82 @@ def extrapolate_many(K: torch.Tensor, obs: Observable, ic_space: np.ndarray, T:
 		T: trajectory length
 
 	Returns:
-		list of trajectories in no particular order
+		list of trajectories, in `itertools.product` order of the initial condition grid
 
 	Assumes inefficient but accurate extrapolation method.
 	This method is non-differentiable.
 	"""
-	trajectories = []
-	N = np.prod(ic_space[:,2])
-	ic_range = [np.linspace(a, b, n) for [a, b, n] in ic_space]
-	with tqdm(total=N, desc='Trajectories') as pbar:
-
-		def finish(tr):
-			trajectories.append(tr)
-			pbar.update(1)
-
-		# https://github.com/pytorch/pytorch/issues/973
-		# torch.multiprocessing.set_sharing_strategy('file_system')
-		with multiprocessing.Pool() as pool:
-			for ic in itertools.product(ic_range):
-				pool.apply_async(_tr_worker, args=(ic, K, obs, T), callback=finish)
-			pool.close()
-			pool.join()
-
-	return trajectories
\ No newline at end of file
+	ic_range = [np.linspace(a, b, int(n)) for [a, b, n] in ic_space]
+	ics = torch.tensor(list(itertools.product(*ic_range)), dtype=K.dtype, device=K.device).t()
+	with torch.no_grad():
+		Y = extrapolate(ics.unsqueeze(1), K, obs, T)
+	return list(torch.unbind(Y, dim=2))
+
+""" Tests """
+
+if __name__ == '__main__':
+	from totorch.utils import set_seed
+	set_seed(9001)
+
+	def rel_err(A, B):
+		return (torch.norm(A.double() - B.double()) / torch.norm(B.double())).item()
+
+	# Stable, diagonalizable operator on polynomial observables (float64 throughout)
+	d = 2
+	obs = PolynomialObservable(2, d, 5)
+	Q = torch.linalg.qr(torch.randn((obs.k, obs.k), dtype=torch.float64))[0]
+	K = 0.9 * Q@torch.diag(torch.linspace(0.5, 1., obs.k, dtype=torch.float64))@Q.t() + 0.05*torch.randn((obs.k, obs.k), dtype=torch.float64)
+	x0 = torch.randn((d, 1), dtype=torch.float64)
+	X0 = torch.randn((d, 1, 4), dtype=torch.float64)
+
+	print('Spectral extrapolation test')
+	T = 20
+	horizons = torch.tensor([0, 3, 7, 20])
+	for ic in (x0, X0):
+		Y = extrapolate(ic, K, obs, T, unlift_every=False)
+		assert rel_err(extrapolate_spectral(ic, K, obs, T), Y) < 1e-8, 'spectral extrapolation does not match rollout'
+		assert rel_err(extrapolate(ic, K, obs, T, unlift_every=False, spectral=True), Y) < 1e-8, 'spectral extrapolate path incorrect'
+		assert rel_err(extrapolate_spectral(ic, K, obs, horizons), Y[:, horizons]) < 1e-8, 'spectral extrapolation at given horizons incorrect'
+	evals, _, _ = spectrum(K)
+	assert spectrum(K)[0] is evals, 'spectrum not cached'
+	K.mul_(0.5) # in-place change invalidates the cached spectrum
+	assert torch.allclose(spectrum(K)[0], 0.5*evals), 'cached spectrum not recomputed after in-place change'
+	assert rel_err(extrapolate_spectral(X0, K, obs, T), extrapolate(X0, K, obs, T, unlift_every=False)) < 1e-8, 'stale spectrum used after in-place change'
+	K.mul_(2.)
+
+	print('Batched extrapolation test')
+	tau, d_u, b = 2, 1, 3
+	delay = DelayObservable(d, tau)
+	B = 0.1*torch.randn((delay.k, d_u), dtype=torch.float64)
+	K_delay = 0.3*torch.randn((delay.k, delay.k), dtype=torch.float64)
+	X0_delay = torch.randn((d, delay.m, b), dtype=torch.float64)
+	u = torch.randn((d_u, T + delay.m, b), dtype=torch.float64) # inputs are indexed from the first initial condition
+	for unlift_every in (True, False):
+		for ob, K_b, ic in ((obs, K, X0), (delay, K_delay, X0_delay)):
+			Y = extrapolate(ic, K_b, ob, T, unlift_every=unlift_every)
+			for i in range(b):
+				assert torch.allclose(Y[:, :, i], extrapolate(ic[:, :, i], K_b, ob, T, unlift_every=unlift_every)), 'batched extrapolation differs from single runs'
+		Y = extrapolate(X0_delay, K_delay, delay, T, B=B, u=u, unlift_every=unlift_every)
+		for i in range(b):
+			Y_i = extrapolate(X0_delay[:, :, i], K_delay, delay, T, B=B, u=u[:, :, i], unlift_every=unlift_every)
+			assert torch.allclose(Y[:, :, i], Y_i), 'batched extrapolation with per-element inputs differs from single runs'
+
+	ic_space = np.array([[-1., 1., 3], [0., 2., 2]])
+	trajectories = extrapolate_many(K, obs, ic_space, T)
+	grid = list(itertools.product(np.linspace(-1., 1., 3), np.linspace(0., 2., 2)))
+	assert len(trajectories) == len(grid), 'extrapolate_many grid size incorrect'
+	for Y, ic in zip(trajectories, grid):
+		assert torch.allclose(Y, extrapolate(torch.tensor(ic, dtype=K.dtype).unsqueeze(1), K, obs, T)), 'extrapolate_many grid order incorrect'
+
+	print('Checkpointed extrapolation test')
+	for unlift_every in (True, False):
+		results = []
+		for checkpoint_every in (None, 3): # 3 does not divide the horizon
+			K_g = K_delay.clone().requires_grad_()
+			X0_g = X0_delay.clone().requires_grad_()
+			u_g = u.clone().requires_grad_()
+			Y = extrapolate(X0_g, K_g, delay, T, B=B, u=u_g, unlift_every=unlift_every, checkpoint_every=checkpoint_every)
+			Y.square().sum().backward()
+			results.append((Y.detach(), K_g.grad, X0_g.grad, u_g.grad))
+		for plain, checkpointed in zip(*results):
+			assert torch.allclose(plain, checkpointed, rtol=1e-12, atol=0.), 'checkpointed rollout differs from plain rollout'
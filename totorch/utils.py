@@ -3,6 +3,7 @@
 import torch
 import numpy as np
 import random
+import weakref
 
 def set_seed(seed=None):
 	"""Set random seed, or reset if None.
@@ -64,6 +65,31 @@ def is_semistable(P: torch.Tensor, eps=1e-2):
 	"""Semistability test for transfer operator using spectral radius """
 	return spectral_radius(P).item() <= 1.0 + eps
 
+class TensorCache:
+	"""Memoize values derived from tensors (e.g. decompositions of a fixed operator).
+
+	Entries are keyed by tensor identity and invalidated when any key tensor is modified in place or freed.
+	"""
+	def __init__(self):
+		self._entries = dict()
+
+	def get(self, tensors: tuple, fn, *extra):
+		"""Return cached fn() for key tensors (plus hashable `extra` key parts), computing it if stale"""
+		key = tuple(id(t) for t in tensors) + extra
+		versions = tuple(t._version for t in tensors)
+		entry = self._entries.get(key)
+		if entry is not None:
+			refs, cached_versions, value = entry
+			if cached_versions == versions and all(r() is t for r, t in zip(refs, tensors)):
+				return value
+		value = fn()
+		refs = [weakref.ref(t, lambda _, key=key: self._entries.pop(key, None)) for t in tensors]
+		self._entries[key] = (refs, versions, value)
+		return value
+
+	def clear(self):
+		self._entries.clear()
+
 def rmse(X: torch.Tensor, Y: torch.Tensor):
 	assert X.shape == Y.shape
 	return torch.sqrt(torch.mean((X - Y)**2)).item()
@@ -100,4 +126,18 @@ if __name__ == '__main__':
 		np_e_max = np.abs(np.linalg.eigvals(P.cpu().numpy())).max()
 		pwr_e_max = spectral_radius(P).item()
 		print('True:', e, 'numpy:', np_e_max, 'pwr_iter:', pwr_e_max)
-		assert np.abs(e - pwr_e_max) < prec
\ No newline at end of file
+		assert np.abs(e - pwr_e_max) < prec
+
+	# Tensor cache test
+	cache = TensorCache()
+	A = torch.randn((3, 3))
+	n_calls = [0]
+	def inverse():
+		n_calls[0] += 1
+		return torch.inverse(A)
+	cache.get((A,), inverse)
+	cache.get((A,), inverse)
+	assert n_calls[0] == 1, 'cache miss on unchanged tensor'
+	A += torch.eye(3)
+	cache.get((A,), inverse)
+	assert n_calls[0] == 2, 'cache hit on modified tensor'